@@ -0,0 +1,105 @@
+"""Startup benchmark for the SevenSky backend
+
+Measures how long `import main` takes and how long a fresh uvicorn process
+needs to answer its first successful request. Results are printed as JSON so
+they can be tracked over time, e.g.:
+
+    uv run python bench_startup.py --runs 5 >> bench_output.txt
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+IMPORT_SNIPPET = (
+    "import time; started = time.perf_counter(); import main; "
+    "print(time.perf_counter() - started)"
+)
+
+BENCH_DATABASE = os.path.join(tempfile.gettempdir(), "sevensky_bench.db")
+
+def bench_env() -> dict:
+    """Environment for benchmark processes
+
+    The warmer is off (it would add upstream noise) and a scratch database
+    keeps the real one untouched.
+    """
+    env = dict(os.environ)
+    env.setdefault("WARM_CACHE_ENABLED", "0")
+    env.setdefault("DATABASE_PATH", BENCH_DATABASE)
+    return env
+
+def measure_import() -> float:
+    """Seconds to import main in a fresh interpreter"""
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET],
+        cwd=SCRIPT_DIR, env=bench_env(), capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def measure_first_request(path: str, timeout: float) -> float:
+    """Seconds from spawning uvicorn until `path` first returns 200"""
+    port = free_port()
+    url = f"http://127.0.0.1:{port}{path}"
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=SCRIPT_DIR, env=bench_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with code {server.returncode}")
+            try:
+                with urllib.request.urlopen(url, timeout=timeout) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+        raise TimeoutError(f"No successful response from {url} within {timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+def summarize(samples: list) -> dict:
+    return {
+        "median_ms": round(statistics.median(samples) * 1000, 1),
+        "min_ms": round(min(samples) * 1000, 1),
+        "max_ms": round(max(samples) * 1000, 1),
+    }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark backend import time and time to first request")
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh processes per measurement")
+    parser.add_argument("--path", default="/", help="Endpoint to wait for (e.g. /profile to include login)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds to wait for the first response")
+    args = parser.parse_args()
+
+    import_samples = [measure_import() for _ in range(args.runs)]
+    request_samples = [measure_first_request(args.path, args.timeout) for _ in range(args.runs)]
+
+    print(json.dumps({
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "runs": args.runs,
+        "import": summarize(import_samples),
+        "first_request": {"path": args.path, **summarize(request_samples)},
+    }))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
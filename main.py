@@ -1,69 +1,626 @@
 import os
+import re
+import time
 import logging
 import sqlite3
-from contextlib import contextmanager
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timezone
+from collections import OrderedDict
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Response, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from atproto import Client, IdResolver, models
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
+from pydantic import BaseModel
 from typing import Optional
 import asyncio
+import json
+import socket
+import zlib
+import sys
+import io
+import html
+import math
+import importlib
+import importlib.util
+import functools
+import multiprocessing
+import threading
 import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import httpcore
+import httpx
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
+def configure_logging():
+    """Configure logging for the server and CLI commands (no-op if already configured)"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+class LazyImport:
+    """Stand-in for a module or module attribute that is imported on first use
+
+    Importing atproto loads thousands of generated models, which dominates
+    startup; deferring it keeps reloads, worker spawn and imports fast.
+    Attributes are cached on the proxy after the first lookup. Loads are
+    serialized so the preload thread and a request thread never import the
+    same package concurrently, which trips over atproto's circular imports.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, module: str, attr: Optional[str] = None):
+        self._module = module
+        self._attr = attr
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            with LazyImport._lock:
+                if self._target is None:
+                    target = importlib.import_module(self._module)
+                    self._target = getattr(target, self._attr) if self._attr else target
+        return self._target
+
+    def __getattr__(self, name: str):
+        value = getattr(self._load(), name)
+        setattr(self, name, value)
+        return value
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+Client = LazyImport("atproto", "Client")
+# atproto does not import its exceptions submodule on the package, so load it directly
+exceptions = LazyImport("atproto_client.exceptions")
+models = LazyImport("atproto", "models")
+
+# Response models on the hot path, built ahead of the first request by preload_atproto()
+PRELOAD_MODELS = [
+    ("ChatBskyConvoListConvos", "Response"),
+    ("ChatBskyConvoGetMessages", "Response"),
+    ("ChatBskyConvoDefs", "MessageView"),
+    ("ChatBskyConvoSendMessage", "Data"),
+    ("AppBskyActorDefs", "ProfileViewDetailed"),
+    ("ComAtprotoRepoUploadBlob", "Response"),
+]
+
+def preload_atproto():
+    """Import atproto and build the pydantic schemas of hot-path models (blocking)"""
+    started = time.perf_counter()
+    for namespace, name in PRELOAD_MODELS:
+        getattr(getattr(models, namespace), name).model_rebuild()
+    logger.info(f"Preloaded atproto models in {time.perf_counter() - started:.2f}s")
+
 load_dotenv()
 USERNAME = os.getenv("ATPROTO_USERNAME")
 PASSWORD = os.getenv("ATPROTO_PASSWORD")
-
-app = FastAPI(title="SevenSky Chat API", version="1.0.0")
+# PDS to log in to; unset means the atproto default (bsky.social)
+ATPROTO_BASE_URL = os.getenv("ATPROTO_BASE_URL")
+
+# Background warm cache settings
+WARM_CACHE_ENABLED = os.getenv("WARM_CACHE_ENABLED", "1") == "1"
+WARM_INTERVAL_MIN = float(os.getenv("WARM_INTERVAL_MIN", "5"))
+WARM_INTERVAL_MAX = float(os.getenv("WARM_INTERVAL_MAX", "60"))
+WARM_MAX_AGE = float(os.getenv("WARM_MAX_AGE", "120"))
+WARM_TOP_CONVOS = int(os.getenv("WARM_TOP_CONVOS", "5"))
+WARM_MESSAGE_LIMIT = int(os.getenv("WARM_MESSAGE_LIMIT", "50"))
+
+# Memory shared by the response, warm message and image metadata caches
+CACHE_MEMORY_BUDGET_MB = float(os.getenv("CACHE_MEMORY_BUDGET_MB", "64"))
+
+# Window in which a finished read is reused by identical requests
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "1.0"))
+
+# Stale-while-revalidate response cache and circuit breaker settings
+SWR_FRESH_FOR = float(os.getenv("SWR_FRESH_FOR", "5"))
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "10"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+
+# Admission control: per-route "route=concurrency:queue" limits for expensive work
+ADMISSION_LIMITS = {
+    route: tuple(int(n) for n in limits.split(":"))
+    for route, limits in (
+        item.split("=") for item in os.getenv(
+            "ADMISSION_LIMITS",
+            "conversations=4:16,messages=8:32,profile=2:8,send=4:16,broadcast=1:2"
+        ).split(",")
+    )
+}
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2"))
+
+# Shared upstream HTTP transport settings
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "20"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "10"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "90"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "1") == "1"
+DNS_CACHE_TTL = float(os.getenv("DNS_CACHE_TTL", "300"))
+
+# How images are attached to messages: "marker" appends an IMAGE_BLOB marker to
+# the text and records metadata in message_images; "record" creates a post
+# holding the image and embeds it in the message natively. Note that in record
+# mode the image post is public on the sender's profile.
+IMAGE_EMBED_MODE = os.getenv("IMAGE_EMBED_MODE", "marker")
+
+# Server-side image normalization (requires Pillow; pillow-heif adds HEIC support)
+IMAGE_NORMALIZE = os.getenv("IMAGE_NORMALIZE", "1") == "1"
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "2048"))
+IMAGE_TARGET_BYTES = int(os.getenv("IMAGE_TARGET_BYTES", "950000"))
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "JPEG").upper()
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", str(os.cpu_count() or 1)))
+# Input limits checked before decoding, so one upload cannot exhaust a worker's memory
+IMAGE_MAX_UPLOAD_BYTES = int(os.getenv("IMAGE_MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", "50000000"))
+
+# Delta reads (messages since a given message)
+DELTA_PAGE_SIZE = int(os.getenv("DELTA_PAGE_SIZE", "20"))
+DELTA_MAX_SCAN = int(os.getenv("DELTA_MAX_SCAN", "200"))
+DELTA_REV_MAX_AGE = float(os.getenv("DELTA_REV_MAX_AGE", "5"))
+
+# Unread tracking settings (used when upstream does not report unread counts)
+UNREAD_PAGE_SIZE = int(os.getenv("UNREAD_PAGE_SIZE", "20"))
+UNREAD_MAX_SCAN = int(os.getenv("UNREAD_MAX_SCAN", "100"))
+# Message revs remembered for mark-read by message ID (about 150 bytes each)
+MESSAGE_REVS_MAX = int(os.getenv("MESSAGE_REVS_MAX", "20000"))
+MARK_READ_FLUSH_DELAY = float(os.getenv("MARK_READ_FLUSH_DELAY", "0.5"))
+
+# Image metadata retention: rows older than this many days are dropped by the
+# periodic compaction job (0, the default, keeps them forever)
+IMAGE_RETENTION_DAYS = int(os.getenv("IMAGE_RETENTION_DAYS", "0"))
+IMAGE_COMPACT_INTERVAL = float(os.getenv("IMAGE_COMPACT_INTERVAL", "21600"))
+IMAGE_COMPACT_BATCH = int(os.getenv("IMAGE_COMPACT_BATCH", "5000"))
+IMAGE_IMPORT_BATCH = int(os.getenv("IMAGE_IMPORT_BATCH", "10000"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Initialize the database, preload atproto and run the background warmer"""
+    global http_client, image_pool
+
+    configure_logging()
+    init_database()
+    # Load the atproto SDK in the background so the first request does not pay for it
+    preload = asyncio.create_task(asyncio.to_thread(preload_atproto))
+
+    warmer = None
+    if WARM_CACHE_ENABLED:
+        warmer = asyncio.create_task(warm_cache_loop())
+    compactor = None
+    if IMAGE_COMPACT_INTERVAL > 0:
+        compactor = asyncio.create_task(compact_loop())
+    try:
+        yield
+    finally:
+        for task in (warmer, compactor):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        if not preload.done():
+            preload.cancel()
+        if http_client is not None:
+            http_client.close()
+            http_client = None
+        if image_pool is not None:
+            image_pool.shutdown(wait=False, cancel_futures=True)
+            image_pool = None
+
+app = FastAPI(title="SevenSky Chat API", version="1.0.0", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
-<<<<<<< HEAD
     allow_origins=[
         "http://localhost:5173",
         "http://localhost:5175",
         "http://localhost:3000",
     ],  # React dev server
-=======
-    allow_origins=["*"],  # Allow all origins for development
->>>>>>> 67f664d (trying to get image support to work)
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
+def approx_size(value, seen: Optional[set] = None) -> int:
+    """Approximate bytes held by a value and everything it references
+
+    Objects shared within the value are counted once.
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, (str, bytes, bytearray, int, float, bool)) or value is None:
+        return size
+    if isinstance(value, dict):
+        return size + sum(approx_size(k, seen) + approx_size(v, seen) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return size + sum(approx_size(item, seen) for item in value)
+    if hasattr(value, '__dict__'):
+        return size + approx_size(vars(value), seen)
+    return size
+
+class FrequencySketch:
+    """Count-min sketch of how often keys were requested recently
+
+    Counters saturate at 15 and are all halved once the sketch has seen ten
+    times as many requests as it has counters, so old popularity fades.
+    """
+
+    SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0x27D4EB2F165667C5)
+
+    def __init__(self, width: int = 1 << 14):
+        self.mask = width - 1
+        self.rows = [bytearray(width) for _ in self.SEEDS]
+        self.additions = 0
+        self.reset_at = width * 10
+
+    def indexes(self, key):
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        return [((h * seed) & 0xFFFFFFFFFFFFFFFF) >> 32 & self.mask for seed in self.SEEDS]
+
+    def add(self, key):
+        for row, index in zip(self.rows, self.indexes(key)):
+            if row[index] < 15:
+                row[index] += 1
+        self.additions += 1
+        if self.additions >= self.reset_at:
+            self.rows = [bytearray(count >> 1 for count in row) for row in self.rows]
+            self.additions //= 2
+
+    def estimate(self, key) -> int:
+        return min(row[index] for row, index in zip(self.rows, self.indexes(key)))
+
+class CacheBudget:
+    """One memory budget shared by all in-process caches, with W-TinyLFU eviction
+
+    New entries land in a small LRU admission window. An entry pushed out of
+    the window only moves into the main area if the frequency sketch rates
+    it above the entries it would displace together, so one-off reads such
+    as delta polls cannot flush hot entries and a large entry only replaces
+    several small ones when it is requested more than all of them combined.
+    The main area is split into probation and protected LRU segments; a hit
+    in probation promotes the entry. Sizes are estimated with approx_size().
+    """
+
+    def __init__(self, max_bytes: int, window_ratio: float = 0.01, protected_ratio: float = 0.8):
+        self.max_bytes = max_bytes
+        self.window_max = max(1, int(max_bytes * window_ratio))
+        self.main_max = max_bytes - self.window_max
+        self.protected_max = int(self.main_max * protected_ratio)
+        # Larger entries would churn the whole cache; they are not cached at all
+        self.max_entry_bytes = max_bytes // 8
+        self.entries = {}  # (cache name, key) -> [value, size, segment]
+        self.segments = {"window": OrderedDict(), "probation": OrderedDict(), "protected": OrderedDict()}
+        self.segment_bytes = {"window": 0, "probation": 0, "protected": 0}
+        self.sketch = FrequencySketch()
+        self.caches = {}
+        # Caches are also read from worker threads (e.g. image metadata during shaping)
+        self.lock = threading.RLock()
+
+    def cache(self, name: str) -> "BudgetedCache":
+        cache = self.caches[name] = BudgetedCache(self, name)
+        return cache
+
+    def get(self, cache: "BudgetedCache", key, default=None, record: bool = True):
+        full_key = (cache.name, key)
+        with self.lock:
+            if record:
+                self.sketch.add(full_key)
+            entry = self.entries.get(full_key)
+            if entry is None:
+                if record:
+                    cache.stats["misses"] += 1
+                return default
+            if record:
+                cache.stats["hits"] += 1
+                self.touch(full_key, entry)
+            return entry[0]
+
+    def touch(self, full_key, entry):
+        segment = entry[2]
+        if segment != "probation":
+            self.segments[segment].move_to_end(full_key)
+            return
+        self.move(full_key, entry, "protected")
+        while self.segment_bytes["protected"] > self.protected_max:
+            demoted = next(iter(self.segments["protected"]))
+            self.move(demoted, self.entries[demoted], "probation")
+
+    def move(self, full_key, entry, segment: str):
+        del self.segments[entry[2]][full_key]
+        self.segment_bytes[entry[2]] -= entry[1]
+        entry[2] = segment
+        self.segments[segment][full_key] = None
+        self.segment_bytes[segment] += entry[1]
+
+    def put(self, cache: "BudgetedCache", key, value):
+        size = approx_size(value)
+        full_key = (cache.name, key)
+        with self.lock:
+            entry = self.entries.get(full_key)
+            if size > self.max_entry_bytes:
+                if entry is not None:
+                    self.remove(full_key)
+                cache.stats["rejected"] += 1
+                return
+            if entry is not None:
+                # Replacing keeps the entry where it is (revalidated entries stay protected)
+                self.segment_bytes[entry[2]] += size - entry[1]
+                cache.stats["bytes"] += size - entry[1]
+                entry[0], entry[1] = value, size
+                self.segments[entry[2]].move_to_end(full_key)
+            else:
+                self.entries[full_key] = [value, size, "window"]
+                self.segments["window"][full_key] = None
+                self.segment_bytes["window"] += size
+                cache.stats["entries"] += 1
+                cache.stats["bytes"] += size
+            while self.segment_bytes["window"] > self.window_max:
+                self.admit(next(iter(self.segments["window"])))
+            while self.segment_bytes["probation"] + self.segment_bytes["protected"] > self.main_max:
+                segment = "probation" if self.segments["probation"] else "protected"
+                self.evict(next(iter(self.segments[segment])))
+
+    def admit(self, candidate):
+        """Move the oldest window entry into the main area, or drop it"""
+        entry = self.entries[candidate]
+        needed = self.segment_bytes["probation"] + self.segment_bytes["protected"] + entry[1] - self.main_max
+        victims = []
+        if needed > 0:
+            freed = 0
+            victim_frequency = 0
+            for segment in ("probation", "protected"):
+                for victim in self.segments[segment]:
+                    if freed >= needed:
+                        break
+                    victims.append(victim)
+                    freed += self.entries[victim][1]
+                    victim_frequency += self.sketch.estimate(victim)
+            if freed < needed or self.sketch.estimate(candidate) <= victim_frequency:
+                self.evict(candidate)
+                return
+        for victim in victims:
+            self.evict(victim)
+        self.move(candidate, entry, "probation")
+
+    def remove(self, full_key):
+        entry = self.entries.pop(full_key, None)
+        if entry is None:
+            return None
+        del self.segments[entry[2]][full_key]
+        self.segment_bytes[entry[2]] -= entry[1]
+        stats = self.caches[full_key[0]].stats
+        stats["entries"] -= 1
+        stats["bytes"] -= entry[1]
+        return entry
+
+    def evict(self, full_key):
+        self.remove(full_key)
+        self.caches[full_key[0]].stats["evictions"] += 1
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "budget_bytes": self.max_bytes,
+                "used_bytes": sum(self.segment_bytes.values()),
+                "segments": dict(self.segment_bytes),
+                "caches": {
+                    name: {
+                        **cache.stats,
+                        "hit_rate": round(cache.stats["hits"] / max(1, cache.stats["hits"] + cache.stats["misses"]), 3)
+                    }
+                    for name, cache in self.caches.items()
+                }
+            }
+
+class BudgetedCache:
+    """A named, dict-like view of the entries one cache keeps in a CacheBudget
+
+    get() counts as a request for hit rates and eviction; peek() does not.
+    """
+
+    def __init__(self, budget: CacheBudget, name: str):
+        self.budget = budget
+        self.name = name
+        self.stats = {"entries": 0, "bytes": 0, "hits": 0, "misses": 0, "evictions": 0, "rejected": 0}
+
+    def get(self, key, default=None):
+        return self.budget.get(self, key, default)
+
+    def peek(self, key, default=None):
+        return self.budget.get(self, key, default, record=False)
+
+    def __setitem__(self, key, value):
+        self.budget.put(self, key, value)
+
+    def pop(self, key, default=None):
+        with self.budget.lock:
+            entry = self.budget.remove((self.name, key))
+        return default if entry is None else entry[0]
+
+    def keys(self) -> list:
+        with self.budget.lock:
+            return [key for name, key in self.budget.entries if name == self.name]
+
+    def clear(self):
+        for key in self.keys():
+            self.pop(key)
+
+    def __contains__(self, key) -> bool:
+        return (self.name, key) in self.budget.entries
+
+    def __len__(self) -> int:
+        return self.stats["entries"]
+
+# Shared memory budget of the in-process caches
+cache_budget = CacheBudget(int(CACHE_MEMORY_BUDGET_MB * 1024 * 1024))
+
+# Stale-while-revalidate results of the read endpoints: key -> (stored_at, result)
+response_cache = cache_budget.cache("responses")
+# Image metadata by message ID. Only found rows are kept: import-images and
+# backfill-images write from another process, so a cached "no row" would hide
+# their rows from the server until evicted.
+image_cache = cache_budget.cache("image_metadata")
+# Revs of messages seen from upstream, so mark-read can place the local cursor
+# at a specific message: message_id -> rev. A plain LRU rather than part of the
+# budget: these entries are written long before they are read, so the TinyLFU
+# admission filter would turn nearly all of them away.
+message_revs = OrderedDict()
+message_revs_lock = threading.Lock()
+
+# Process pool for image normalization, created on first use
+image_pool = None
+
+# Shared upstream HTTP client, created on first use
+http_client = None
+http_stats = {"requests": 0, "connections": 0, "dns_hits": 0, "dns_misses": 0, "http_versions": {}}
+dns_cache = {}  # (host, port) -> (expires_at, [address, ...])
+
 # Global client instance
 client = None
 dm_client = None
 dm = None
+client_lock = asyncio.Lock()
+
+# In-memory cache kept fresh by the background warmer
+warm_cache = {
+    "conversations": None,
+    "conversations_at": 0.0,
+    "revs": {},
+    # convo_id -> {"messages": [...], "limit": int, "fetched_at": float}
+    "messages": cache_budget.cache("warm_messages"),
+    "interval": WARM_INTERVAL_MIN,
+}
+warm_wakeup = asyncio.Event()
+
+# Identical concurrent reads share one upstream call: key -> task / (finished_at, result)
+inflight_reads = {}
+recent_reads = {}
+coalesce_stats = {"upstream": 0, "coalesced": 0, "micro_cached": 0}
+
+# Circuit breaker state per upstream method: name -> {"failures", "opened_at", "trial"}
+circuits = {}
+
+# Admission state per route; semaphores are kept apart so the stats stay serializable
+admission_stats = {}
+admission_semaphores = {}
+
+# Per-conversation read state: convo_id -> {"read_rev", "seen_rev", "unread"}
+read_state = {}
+# Pending mark-read calls, flushed to upstream in one batch: convo_id -> message_id
+pending_reads = {}
+pending_reads_task = None
+
+# Outcome of the most recent image store compaction
+image_store_stats = {"last_compaction": None}
 
 # Database setup
-DATABASE_PATH = "chat_images.db"
+DATABASE_PATH = os.getenv("DATABASE_PATH", "chat_images.db")
+
+# Image marker appended to message text when an image is attached
+IMAGE_MARKER_RE = re.compile(r'\s*📷 IMAGE_BLOB:[a-z0-9]{59}')
+
+# Schema migrations, applied in order; PRAGMA user_version records how many have run
+MIGRATIONS = [
+    # 1: baseline schema
+    [
+        """
+        CREATE TABLE IF NOT EXISTS message_images (
+            message_id TEXT PRIMARY KEY,
+            blob_cid TEXT NOT NULL,
+            blob_url TEXT NOT NULL,
+            filename TEXT,
+            mime_type TEXT,
+            size INTEGER,
+            user_did TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS search_messages (
+            message_id TEXT PRIMARY KEY,
+            convo_id TEXT NOT NULL,
+            sender_did TEXT,
+            sent_at TEXT,
+            text TEXT NOT NULL
+        )
+        """,
+        # Full-text index over search_messages, kept in sync by triggers
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5(
+            text,
+            content='search_messages',
+            content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS search_messages_ai AFTER INSERT ON search_messages BEGIN
+            INSERT INTO message_search(rowid, text) VALUES (new.rowid, new.text);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS search_messages_ad AFTER DELETE ON search_messages BEGIN
+            INSERT INTO message_search(message_search, rowid, text) VALUES ('delete', old.rowid, old.text);
+        END
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_search_messages_convo
+        ON search_messages (convo_id, sent_at)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS read_cursors (
+            convo_id TEXT PRIMARY KEY,
+            message_id TEXT,
+            rev TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ],
+    # 2: secondary indexes for CID lookups, per-user listings and retention
+    [
+        "CREATE INDEX IF NOT EXISTS idx_message_images_blob_cid ON message_images (blob_cid)",
+        "CREATE INDEX IF NOT EXISTS idx_message_images_user ON message_images (user_did, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_message_images_created ON message_images (created_at)",
+    ],
+]
 
 def init_database():
-    """Initialize the SQLite database with required tables"""
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS message_images (
-                message_id TEXT PRIMARY KEY,
-                blob_cid TEXT NOT NULL,
-                blob_url TEXT NOT NULL,
-                filename TEXT,
-                mime_type TEXT,
-                size INTEGER,
-                user_did TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        conn.commit()
+    """Initialize the SQLite database and apply pending schema migrations"""
+    conn = sqlite3.connect(DATABASE_PATH, isolation_level=None)
+    try:
+        # Incremental auto-vacuum lets compaction hand free pages back to the
+        # filesystem without rewriting the whole file. It can be set for free
+        # on a new database; switching an existing one needs a full VACUUM,
+        # which is left to the compact-images command rather than startup.
+        if conn.execute("PRAGMA page_count").fetchone()[0] == 0:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        elif conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            logger.info("Database does not use incremental auto-vacuum; "
+                        "run 'python main.py compact-images' once to switch it over")
+
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info(f"Applying database migration {number}")
+            conn.execute("BEGIN")
+            try:
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {number}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    finally:
+        conn.close()
 
 @contextmanager
 def get_db():
@@ -75,16 +632,31 @@ def get_db():
     finally:
         conn.close()
 
+# Upsert that leaves unchanged rows (and their created_at) alone instead of
+# deleting and re-inserting them like INSERT OR REPLACE would
+IMAGE_UPSERT_SQL = """
+    INSERT INTO message_images
+    (message_id, blob_cid, blob_url, filename, mime_type, size, user_did, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+    ON CONFLICT (message_id) DO UPDATE SET
+        blob_cid = excluded.blob_cid,
+        blob_url = excluded.blob_url,
+        filename = excluded.filename,
+        mime_type = excluded.mime_type,
+        size = excluded.size,
+        user_did = excluded.user_did
+    WHERE (blob_cid, blob_url, filename, mime_type, size, user_did)
+        IS NOT (excluded.blob_cid, excluded.blob_url, excluded.filename,
+                excluded.mime_type, excluded.size, excluded.user_did)
+"""
+
 def store_image_info(message_id: str, blob_cid: str, blob_url: str,
                     filename: str, mime_type: str, size: int, user_did: str):
     """Store image metadata in database"""
     with get_db() as conn:
-        conn.execute("""
-            INSERT OR REPLACE INTO message_images
-            (message_id, blob_cid, blob_url, filename, mime_type, size, user_did)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (message_id, blob_cid, blob_url, filename, mime_type, size, user_did))
+        conn.execute(IMAGE_UPSERT_SQL, (message_id, blob_cid, blob_url, filename, mime_type, size, user_did, None))
         conn.commit()
+    image_cache.pop(message_id)
 
 def get_image_info(message_id: str) -> dict:
     """Get image metadata from database"""
@@ -105,24 +677,497 @@ def get_image_info(message_id: str) -> dict:
             }
         return None
 
-# Initialize database on startup
-init_database()
+def store_read_cursor(convo_id: str, message_id: Optional[str], rev: Optional[str]):
+    """Persist the local read cursor of a conversation"""
+    with get_db() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO read_cursors (convo_id, message_id, rev, updated_at)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        """, (convo_id, message_id, rev))
+        conn.commit()
+
+def get_read_state(convo_id: str) -> dict:
+    """Get the in-memory read state of a conversation, seeded from the database"""
+    state = read_state.get(convo_id)
+    if state is None:
+        with get_db() as conn:
+            row = conn.execute(
+                "SELECT rev FROM read_cursors WHERE convo_id = ?", (convo_id,)
+            ).fetchone()
+        state = {"read_rev": row["rev"] if row else None, "seen_rev": None, "unread": 0}
+        read_state[convo_id] = state
+    return state
+
+def store_image_infos(rows: list):
+    """Store image metadata for many messages in a single transaction
+
+    Each row is (message_id, blob_cid, blob_url, filename, mime_type, size, user_did).
+    """
+    if not rows:
+        return
+    with get_db() as conn:
+        conn.executemany(IMAGE_UPSERT_SQL, [(*row, None) for row in rows])
+        conn.commit()
+    for row in rows:
+        image_cache.pop(row[0])
+
+def import_image_rows(rows, batch_size: int = IMAGE_IMPORT_BATCH) -> int:
+    """Bulk-load image metadata from an iterable, one transaction per batch
+
+    Each row is (message_id, blob_cid, blob_url, filename, mime_type, size,
+    user_did, created_at); created_at may be None for "now". Rows are consumed
+    lazily, so arbitrarily large imports run in constant memory.
+    """
+    imported = 0
+    with get_db() as conn:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                conn.executemany(IMAGE_UPSERT_SQL, batch)
+                conn.commit()
+                imported += len(batch)
+                batch = []
+        if batch:
+            conn.executemany(IMAGE_UPSERT_SQL, batch)
+            conn.commit()
+            imported += len(batch)
+    if imported:
+        image_cache.clear()
+    return imported
+
+def get_image_infos(message_ids: list) -> dict:
+    """Get image metadata for many messages, keyed by message ID
+
+    Found rows are kept in image_cache; IDs not cached are read in one query.
+    """
+    infos = {}
+    missing = []
+    for message_id in message_ids:
+        info = image_cache.get(message_id)
+        if info is None:
+            missing.append(message_id)
+        else:
+            infos[message_id] = info
+    if not missing:
+        return infos
+    placeholders = ",".join("?" for _ in missing)
+    with get_db() as conn:
+        rows = conn.execute(f"""
+            SELECT message_id, blob_cid, blob_url, filename, mime_type, size, user_did
+            FROM message_images WHERE message_id IN ({placeholders})
+        """, missing).fetchall()
+    found = {
+        row["message_id"]: {
+            "blob_cid": row["blob_cid"],
+            "blob_url": row["blob_url"],
+            "filename": row["filename"],
+            "mime_type": row["mime_type"],
+            "size": row["size"],
+            "user_did": row["user_did"]
+        }
+        for row in rows
+    }
+    for message_id, info in found.items():
+        image_cache[message_id] = info
+    infos.update(found)
+    return infos
+
+def find_images(blob_cid: Optional[str] = None, user_did: Optional[str] = None,
+                before: Optional[str] = None, limit: int = 50) -> list:
+    """Image metadata by blob CID or by uploader, newest first
+
+    Both filters are served by secondary indexes; `before` pages through a
+    user's images by created_at.
+    """
+    clauses, params = [], []
+    if blob_cid:
+        clauses.append("blob_cid = ?")
+        params.append(blob_cid)
+    if user_did:
+        clauses.append("user_did = ?")
+        params.append(user_did)
+    if before:
+        clauses.append("created_at < ?")
+        params.append(before)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    with get_db() as conn:
+        rows = conn.execute(f"""
+            SELECT message_id, blob_cid, blob_url, filename, mime_type, size, user_did, created_at
+            FROM message_images {where}
+            ORDER BY created_at DESC LIMIT ?
+        """, params + [limit]).fetchall()
+    return [dict(row) for row in rows]
+
+def compact_image_store(retention_days: int = IMAGE_RETENTION_DAYS,
+                        batch_size: int = IMAGE_COMPACT_BATCH,
+                        enable_auto_vacuum: bool = False) -> dict:
+    """Drop image metadata past its retention and return free pages to the filesystem
+
+    Rows are deleted in small batches so concurrent requests are never locked
+    out for long. Marker messages whose row is gone still render through the
+    CDN URL derived from their CID, only the filename and size are lost.
+    With enable_auto_vacuum, a database without incremental auto-vacuum is
+    switched over with a full VACUUM, which locks it for the duration.
+    """
+    started = time.monotonic()
+    deleted = 0
+    with get_db() as conn:
+        if retention_days > 0:
+            cutoff = f"-{retention_days} days"
+            while True:
+                cursor = conn.execute("""
+                    DELETE FROM message_images WHERE rowid IN (
+                        SELECT rowid FROM message_images
+                        WHERE created_at < datetime('now', ?) LIMIT ?
+                    )
+                """, (cutoff, batch_size))
+                conn.commit()
+                deleted += cursor.rowcount
+                if cursor.rowcount < batch_size:
+                    break
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if enable_auto_vacuum and conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            logger.info("Switching the database to incremental auto-vacuum")
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        else:
+            # incremental_vacuum frees one page per result row, so drain it
+            conn.execute("PRAGMA incremental_vacuum").fetchall()
+            conn.commit()
+    if deleted:
+        image_cache.clear()
+    result = {
+        "deleted": deleted,
+        "freed_pages": free_pages,
+        "duration": round(time.monotonic() - started, 3),
+        "finished_at": datetime.now().isoformat()
+    }
+    image_store_stats["last_compaction"] = result
+    return result
+
+def get_image_store_stats() -> dict:
+    """Schema version and on-disk size of the database"""
+    with get_db() as conn:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        return {
+            "schema_version": conn.execute("PRAGMA user_version").fetchone()[0],
+            "bytes": page_size * page_count,
+            "free_pages": conn.execute("PRAGMA freelist_count").fetchone()[0],
+            "incremental_vacuum": conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2,
+            "retention_days": IMAGE_RETENTION_DAYS,
+            "last_compaction": image_store_stats["last_compaction"]
+        }
+
+async def compact_loop():
+    """Periodically apply image metadata retention and compact the database"""
+    while True:
+        await asyncio.sleep(IMAGE_COMPACT_INTERVAL)
+        try:
+            result = await asyncio.to_thread(compact_image_store)
+            logger.info(f"Compacted image store: {result}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Image store compaction failed: {e}")
+
+def search_rows(convo_id: str, msgs: list) -> list:
+    """search_messages rows for the messages that have searchable text"""
+    rows = []
+    for msg in msgs:
+        text = getattr(msg, 'text', None)
+        if text is None:
+            continue
+        text = IMAGE_MARKER_RE.sub('', text).replace(SNIPPET_OPEN, '').replace(SNIPPET_CLOSE, '').strip()
+        if text:
+            rows.append((msg.id, convo_id, msg.sender.did, str(msg.sent_at), text))
+    return rows
+
+def store_search_rows(rows: list):
+    """Insert search_messages rows in one transaction, skipping ones already indexed"""
+    if not rows:
+        return
+    with get_db() as conn:
+        conn.executemany("""
+            INSERT OR IGNORE INTO search_messages (message_id, convo_id, sender_did, sent_at, text)
+            VALUES (?, ?, ?, ?, ?)
+        """, rows)
+        conn.commit()
+
+def index_messages(convo_id: str, msgs: list):
+    """Add messages to the full-text search index, skipping ones already indexed"""
+    store_search_rows(search_rows(convo_id, msgs))
+
+def unindex_messages(message_ids: list):
+    """Remove deleted messages from the full-text search index"""
+    if not message_ids:
+        return
+    with get_db() as conn:
+        conn.executemany("DELETE FROM search_messages WHERE message_id = ?",
+                         [(message_id,) for message_id in message_ids])
+        conn.commit()
+
+def build_search_query(query: str) -> str:
+    """Turn free text into a safe FTS5 query: quoted terms, prefix match on the last one"""
+    terms = [term.replace('"', '""') for term in query.split()]
+    if not terms:
+        return ""
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+# Match delimiters for snippet(); control characters cannot come from message text
+# (index_messages strips them), so they survive HTML escaping unambiguously
+SNIPPET_OPEN = "\x02"
+SNIPPET_CLOSE = "\x03"
+
+def highlight_snippet(snippet: str) -> str:
+    """HTML-escape a snippet and mark its matches with <mark> tags"""
+    return html.escape(snippet).replace(SNIPPET_OPEN, "<mark>").replace(SNIPPET_CLOSE, "</mark>")
+
+def search_messages(query: str, convo_id: Optional[str] = None, limit: int = 20) -> list:
+    """Search indexed messages, best matches first"""
+    match = build_search_query(query)
+    if not match:
+        return []
+    sql = """
+        SELECT m.message_id, m.convo_id, m.sender_did, m.sent_at,
+               snippet(message_search, 0, ?, ?, '…', 12) AS snippet,
+               message_search.rank AS rank
+        FROM message_search
+        JOIN search_messages m ON m.rowid = message_search.rowid
+        WHERE message_search MATCH ?
+    """
+    params = [SNIPPET_OPEN, SNIPPET_CLOSE, match]
+    if convo_id:
+        sql += " AND m.convo_id = ?"
+        params.append(convo_id)
+    sql += " ORDER BY message_search.rank LIMIT ?"
+    params.append(limit)
+
+    with get_db() as conn:
+        rows = conn.execute(sql, params).fetchall()
+    return [
+        {
+            "messageId": row["message_id"],
+            "convoId": row["convo_id"],
+            "senderDid": row["sender_did"],
+            "createdAt": row["sent_at"],
+            "snippet": highlight_snippet(row["snippet"]),
+            "rank": row["rank"]
+        }
+        for row in rows
+    ]
+
+def resolve_cached(host: str, port: int) -> list:
+    """Resolve a host to its IP addresses, caching the answer for DNS_CACHE_TTL"""
+    try:
+        socket.inet_pton(socket.AF_INET6 if ":" in host else socket.AF_INET, host)
+        return [host]
+    except OSError:
+        pass
+
+    cached = dns_cache.get((host, port))
+    if cached and cached[0] > time.monotonic():
+        http_stats["dns_hits"] += 1
+        return cached[1]
+
+    http_stats["dns_misses"] += 1
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    addresses = list(dict.fromkeys(info[4][0] for info in infos))
+    dns_cache[(host, port)] = (time.monotonic() + DNS_CACHE_TTL, addresses)
+    return addresses
+
+class CachingNetworkBackend(httpcore.SyncBackend):
+    """Network backend that caches DNS lookups and counts new connections
+
+    Every new connection means a TCP (and usually TLS) handshake, so comparing
+    the connection count with the request count shows how well keep-alive
+    connections are being reused. TLS still verifies against the original
+    hostname, which httpcore passes separately as the SNI server name.
+    """
+
+    def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        http_stats["connections"] += 1
+        try:
+            addresses = resolve_cached(host, port)
+        except socket.gaierror as e:
+            raise httpcore.ConnectError(str(e)) from e
+        # Like socket.create_connection, try every address in turn (an AAAA
+        # record without an IPv6 route must not fail the connection)
+        for address in addresses:
+            try:
+                stream = super().connect_tcp(address, port, timeout, local_address, socket_options)
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as e:
+                error = e
+                continue
+            cached = dns_cache.get((host, port))
+            if cached and address != addresses[0]:
+                # Dial the address that worked first from now on
+                dns_cache[(host, port)] = (cached[0], [address] + [a for a in addresses if a != address])
+            return stream
+        # Every cached address failed; they may have gone stale, so resolve again next time
+        dns_cache.pop((host, port), None)
+        raise error
+
+# httpcore errors raised through PooledTransport, as the httpx errors callers expect
+HTTPCORE_ERRORS = (
+    (httpcore.ConnectTimeout, httpx.ConnectTimeout),
+    (httpcore.ReadTimeout, httpx.ReadTimeout),
+    (httpcore.WriteTimeout, httpx.WriteTimeout),
+    (httpcore.PoolTimeout, httpx.PoolTimeout),
+    (httpcore.TimeoutException, httpx.TimeoutException),
+    (httpcore.ConnectError, httpx.ConnectError),
+    (httpcore.ReadError, httpx.ReadError),
+    (httpcore.WriteError, httpx.WriteError),
+    (httpcore.NetworkError, httpx.NetworkError),
+    (httpcore.RemoteProtocolError, httpx.RemoteProtocolError),
+    (httpcore.LocalProtocolError, httpx.LocalProtocolError),
+    (httpcore.ProtocolError, httpx.ProtocolError),
+    (httpcore.UnsupportedProtocol, httpx.UnsupportedProtocol),
+)
+
+@contextmanager
+def httpx_errors(request: httpx.Request):
+    try:
+        yield
+    except (httpcore.TimeoutException, httpcore.NetworkError,
+            httpcore.ProtocolError, httpcore.UnsupportedProtocol) as e:
+        mapped = next(mapped for error, mapped in HTTPCORE_ERRORS if isinstance(e, error))
+        raise mapped(str(e), request=request) from e
+
+class PooledResponseStream(httpx.SyncByteStream):
+    def __init__(self, stream, request: httpx.Request):
+        self.stream = stream
+        self.request = request
+
+    def __iter__(self):
+        with httpx_errors(self.request):
+            yield from self.stream
+
+    def close(self):
+        if hasattr(self.stream, "close"):
+            self.stream.close()
+
+class PooledTransport(httpx.BaseTransport):
+    """httpx transport over an httpcore connection pool
+
+    httpx.HTTPTransport builds its own pool with the default network backend;
+    building the pool here lets it use CachingNetworkBackend.
+    """
+
+    def __init__(self, pool: httpcore.ConnectionPool):
+        self.pool = pool
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(
+                scheme=request.url.raw_scheme,
+                host=request.url.raw_host,
+                port=request.url.port,
+                target=request.url.raw_path
+            ),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions
+        )
+        with httpx_errors(request):
+            core_response = self.pool.handle_request(core_request)
+        return httpx.Response(
+            status_code=core_response.status,
+            headers=core_response.headers,
+            stream=PooledResponseStream(core_response.stream, request),
+            extensions=core_response.extensions
+        )
+
+    def close(self):
+        self.pool.close()
+
+def count_response(response: httpx.Response):
+    http_stats["requests"] += 1
+    versions = http_stats["http_versions"]
+    versions[response.http_version] = versions.get(response.http_version, 0) + 1
+
+def get_http_client() -> httpx.Client:
+    """Get or create the HTTP client shared by all upstream traffic"""
+    global http_client
+
+    if http_client is None:
+        http2 = UPSTREAM_HTTP2 and importlib.util.find_spec("h2") is not None
+        if UPSTREAM_HTTP2 and not http2:
+            logger.info("h2 is not installed, upstream HTTP will use HTTP/1.1")
+        pool = httpcore.ConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+            http2=http2,
+            retries=1,
+            network_backend=CachingNetworkBackend()
+        )
+        http_client = httpx.Client(
+            transport=PooledTransport(pool),
+            timeout=httpx.Timeout(UPSTREAM_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+            follow_redirects=True,
+            event_hooks={"response": [count_response]}
+        )
+    return http_client
+
+@functools.cache
+def shared_request_class():
+    """Build the shared request class once atproto is imported"""
+    Client._load()
+    from atproto_client.request import Request, RequestBase
+
+    class SharedRequest(Request):
+        """atproto request handler that sends everything over the shared HTTP client
+
+        Clients cloned from it (such as the chat proxy client) share the same
+        connection pool instead of opening their own.
+        """
+
+        def __init__(self, **kwargs):
+            RequestBase.__init__(self)
+            self._client_kwargs = {}
+            self._client = get_http_client()
+
+        def _new_instance(self):
+            return type(self)()
+
+        def close(self):
+            # The shared pool outlives individual atproto clients
+            pass
+
+    return SharedRequest
+
+def get_http_stats() -> dict:
+    """Connection reuse statistics for upstream HTTP traffic"""
+    requests = http_stats["requests"]
+    connections = http_stats["connections"]
+    return {
+        **http_stats,
+        "reuse_ratio": round(1 - connections / requests, 3) if requests else None
+    }
 
 async def get_client():
     """Get or create ATProtocol client"""
     global client, dm_client, dm
 
     try:
-        if client is None:
-            logger.info("Creating new ATProtocol client...")
-            client = Client()
-            logger.info(f"Logging in with username: {USERNAME}")
-            client.login(USERNAME, PASSWORD)
-            logger.info("Successfully logged in to ATProtocol")
-
-            dm_client = client.with_bsky_chat_proxy()
-            dm = dm_client.chat.bsky.convo
-            logger.info("Created chat proxy client")
+        async with client_lock:
+            if client is None:
+                logger.info("Creating new ATProtocol client...")
+                new_client = Client(base_url=ATPROTO_BASE_URL, request=shared_request_class()())
+                logger.info(f"Logging in with username: {USERNAME}")
+                await asyncio.to_thread(new_client.login, USERNAME, PASSWORD)
+                logger.info("Successfully logged in to ATProtocol")
+
+                dm_client = new_client.with_bsky_chat_proxy()
+                dm = dm_client.chat.bsky.convo
+                client = new_client
+                logger.info("Created chat proxy client")
 
         return client, dm
     except Exception as e:
@@ -142,181 +1187,1146 @@ def upload_image(client: Client, image_data: bytes):
         logger.error(f"Traceback: {traceback.format_exc()}")
         raise
 
-@app.get("/")
-async def root():
-    return {"message": "SevenSky Chat API is running!"}
+def image_blob_url(user_did: str, blob_cid: str) -> str:
+    """URL the frontend loads an uploaded image blob from"""
+    # Try different blob serving endpoints - bsky.social sometimes has issues
+    return f"https://cdn.bsky.app/img/feed_fullsize/plain/{user_did}/{blob_cid}@jpeg"
 
-@app.get("/conversations")
-async def get_conversations():
-    """Get all conversations for the current user"""
-    try:
-        logger.info("Getting conversations...")
-        client, dm = await get_client()
+def add_image_marker(text: str, blob_cid: str) -> str:
+    """Append the image marker that lets readers find the blob of a message"""
+    if not text.strip():
+        return f"📷 IMAGE_BLOB:{blob_cid}"
+    return f"{text} 📷 IMAGE_BLOB:{blob_cid}"
 
-        logger.info("Fetching conversation list from ATProtocol...")
-        convo_list = dm.list_convos()
-        logger.info(f"Found {len(convo_list.convos)} conversations")
+class ImageRejected(Exception):
+    """Raised when an uploaded file cannot be decoded as an image"""
 
-        conversations = []
-        for i, convo in enumerate(convo_list.convos):
-            try:
-                logger.info(f"Processing conversation {i+1}/{len(convo_list.convos)}: {convo.id}")
+@functools.cache
+def register_image_plugins():
+    """Enable optional decoders (HEIC/HEIF via pillow-heif) when installed"""
+    if importlib.util.find_spec("pillow_heif") is not None:
+        import pillow_heif
+        pillow_heif.register_heif_opener()
+
+def normalize_image(image_data: bytes) -> tuple[bytes, str]:
+    """Decode, strip metadata, resize and re-encode an image to fit IMAGE_TARGET_BYTES
 
-                # Get the last message for each conversation
-                last_message = None
+    Runs in a worker process. Returns the encoded bytes and their MIME type.
+    """
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    register_image_plugins()
+    try:
+        image = Image.open(io.BytesIO(image_data))
+        # open() only reads the header; refuse before the pixels are decoded
+        if image.width * image.height > IMAGE_MAX_PIXELS:
+            raise ImageRejected(
+                f"Image too large: {image.width}x{image.height} exceeds {IMAGE_MAX_PIXELS} pixels"
+            )
+        # Animated images would lose their frames; keep them as they are if they fit
+        if getattr(image, "n_frames", 1) > 1 and len(image_data) <= IMAGE_TARGET_BYTES:
+            return image_data, Image.MIME.get(image.format, "application/octet-stream")
+        # Apply the EXIF orientation before the metadata is dropped by re-encoding
+        image = ImageOps.exif_transpose(image)
+    except (UnidentifiedImageError, OSError) as e:
+        raise ImageRejected(f"Unsupported image: {e}")
+    except Image.DecompressionBombError as e:
+        # More pixels than Image.MAX_IMAGE_PIXELS allows; refuse before decoding
+        raise ImageRejected(f"Image too large: {e}")
+
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+    if IMAGE_OUTPUT_FORMAT == "WEBP" and has_alpha:
+        image = image.convert("RGBA")
+    elif has_alpha:
+        # JPEG has no alpha channel; flatten onto white
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image.convert("RGBA"), mask=image.convert("RGBA").getchannel("A"))
+        image = background
+    else:
+        image = image.convert("RGB")
+
+    max_dimension = IMAGE_MAX_DIMENSION
+    while True:
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        for quality in (85, 75, 65, 55, 45):
+            output = io.BytesIO()
+            image.save(output, format=IMAGE_OUTPUT_FORMAT, quality=quality, optimize=True)
+            if output.tell() <= IMAGE_TARGET_BYTES:
+                return output.getvalue(), Image.MIME[IMAGE_OUTPUT_FORMAT]
+        # Still too large at the lowest quality; shrink and try again
+        max_dimension = int(max(image.size) * 0.75)
+
+def get_image_pool() -> ProcessPoolExecutor:
+    """Get or create the process pool used for image normalization"""
+    global image_pool
+
+    if image_pool is None:
+        # spawn: forking a process that runs threads (uvicorn, to_thread) is unsafe
+        image_pool = ProcessPoolExecutor(
+            max_workers=IMAGE_PROCESS_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return image_pool
+
+def discard_image_pool(pool: ProcessPoolExecutor):
+    """Drop a pool whose worker was killed (typically out of memory)
+
+    A broken pool fails every later submit, so the next caller of
+    get_image_pool() starts a new one.
+    """
+    global image_pool
+
+    logger.error("Image worker died, replacing the process pool")
+    if image_pool is pool:
+        image_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+async def prepare_image(image_data: bytes) -> bytes:
+    """Normalize an uploaded image off the event loop, if Pillow is available
+
+    Raises HTTPException(413) for files over IMAGE_MAX_UPLOAD_BYTES, 400 for
+    files that are not decodable images and 503 when the worker processing
+    the image died (the pool is replaced for the next request).
+    """
+    if len(image_data) > IMAGE_MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Image larger than {IMAGE_MAX_UPLOAD_BYTES} bytes")
+    if not IMAGE_NORMALIZE or importlib.util.find_spec("PIL") is None:
+        return image_data
+    started = time.perf_counter()
+    pool = get_image_pool()
+    try:
+        future = pool.submit(normalize_image, image_data)
+    except BrokenProcessPool:
+        # A worker died while the pool was idle; this image is not to blame
+        discard_image_pool(pool)
+        pool = get_image_pool()
+        future = pool.submit(normalize_image, image_data)
+    try:
+        normalized, mime_type = await asyncio.wrap_future(future)
+    except ImageRejected as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except BrokenProcessPool:
+        discard_image_pool(pool)
+        raise HTTPException(status_code=503, detail="Image processing failed, try again",
+                            headers={"Retry-After": "1"})
+    logger.info(
+        f"Normalized image {len(image_data)} -> {len(normalized)} bytes ({mime_type}) "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
+    return normalized
+
+def shape_author(sender) -> dict:
+    """Convert a message sender into the author format the frontend expects"""
+    return {
+        "did": sender.did,
+        "handle": sender.did,
+        "displayName": getattr(sender, 'displayName', None),
+        "avatar": getattr(sender, 'avatar', None)
+    }
+
+def create_image_embed(client: Client, blob, alt: str):
+    """Store an uploaded image in a post and return a record embed pointing at it (blocking)"""
+    post = client.send_post(
+        text="",
+        embed=models.AppBskyEmbedImages.Main(images=[models.AppBskyEmbedImages.Image(alt=alt, image=blob)])
+    )
+    logger.info(f"Created image post {post.uri}")
+    return models.AppBskyEmbedRecord.Main(record=models.create_strong_ref(post))
+
+def shape_record_embed(embed) -> Optional[dict]:
+    """Convert a native record embed whose record carries images into the frontend embed format"""
+    record = getattr(embed, 'record', None)
+    for inner in getattr(record, 'embeds', None) or []:
+        images = getattr(inner, 'images', None)
+        if not images:
+            continue
+        return {
+            "images": [
+                {
+                    "image": {
+                        # fullsize URLs end in /<did>/<cid>@<format>
+                        "ref": {"$link": image.fullsize.rsplit("/", 1)[-1].split("@")[0]},
+                        "mimeType": None,
+                        "size": None
+                    },
+                    "alt": image.alt,
+                    "blob_url": image.fullsize
+                }
+                for image in images
+            ]
+        }
+    return None
+
+def shape_message(msg, image_infos: Optional[dict] = None) -> dict:
+    """Convert an ATProtocol message view into the frontend message format
+
+    image_infos maps message IDs to stored image metadata for legacy
+    IMAGE_BLOB marker messages; callers look it up once per page.
+    """
+    embed = getattr(msg, 'embed', None)
+    text = msg.text
+
+    # Images sent as native embeds carry everything the reader needs
+    if embed is not None:
+        embed = shape_record_embed(embed) or embed
+
+    # Legacy messages reference their image with a marker in the text
+    elif "IMAGE_BLOB:" in text:
+        blob_match = re.search(r'IMAGE_BLOB:([a-z0-9]{59})', text)
+        if blob_match:
+            blob_cid = blob_match.group(1)
+            img_info = (image_infos or {}).get(msg.id)
+            if img_info:
+                # Create embed format that frontend expects
+                embed = {
+                    "images": [{
+                        "image": {
+                            "ref": {"$link": blob_cid},
+                            "mimeType": img_info["mime_type"],
+                            "size": img_info["size"]
+                        },
+                        "alt": f"Image: {img_info['filename']}" if img_info["filename"] else "Image",
+                        "blob_url": img_info["blob_url"]
+                    }]
+                }
+            else:
+                # No database entry (not backfilled yet, or the database was
+                # cleared); the blob still lives in the sender's repo
+                embed = {
+                    "images": [{
+                        "image": {"ref": {"$link": blob_cid}, "mimeType": None, "size": None},
+                        "alt": "Image",
+                        "blob_url": image_blob_url(msg.sender.did, blob_cid)
+                    }]
+                }
+
+            # Clean up the text by removing the blob marker
+            clean_text = IMAGE_MARKER_RE.sub('', text).strip()
+            text = clean_text if clean_text else "📷 Image"
+        else:
+            logger.warning(f"Could not extract blob CID from: {text}")
+
+    return {
+        "id": msg.id,
+        "text": text,
+        "author": shape_author(msg.sender),
+        "createdAt": msg.sent_at,
+        "embed": embed
+    }
+
+def marker_image_infos(msgs: list) -> dict:
+    """Stored image metadata for the legacy marker messages of a page, in one query"""
+    return get_image_infos([
+        msg.id for msg in msgs
+        if getattr(msg, 'embed', None) is None and "IMAGE_BLOB:" in (getattr(msg, 'text', None) or "")
+    ])
+
+def current_did() -> Optional[str]:
+    """DID of the logged-in user, if the client has logged in"""
+    me = getattr(client, 'me', None) if client else None
+    return me.did if me else None
+
+def remember_message_rev(message_id: str, rev: str):
+    """Record the rev of a message, evicting the least recently seen past MESSAGE_REVS_MAX"""
+    with message_revs_lock:
+        message_revs[message_id] = rev
+        message_revs.move_to_end(message_id)
+        while len(message_revs) > MESSAGE_REVS_MAX:
+            message_revs.popitem(last=False)
+
+def note_messages(convo_id: str, msgs: list):
+    """Advance the local read state with messages seen from upstream
+
+    Only messages newer than the last one seen are counted, so keeping the
+    unread count current costs O(new messages) rather than O(history).
+    """
+    state = get_read_state(convo_id)
+    my_did = current_did()
+    newest = state["seen_rev"]
+    for msg in msgs:
+        rev = getattr(msg, 'rev', None)
+        if rev is not None:
+            remember_message_rev(msg.id, rev)
+        if rev is None or (state["seen_rev"] and rev <= state["seen_rev"]):
+            continue
+        if newest is None or rev > newest:
+            newest = rev
+        if state["read_rev"] and rev <= state["read_rev"]:
+            continue
+        if my_did and msg.sender.did == my_did:
+            continue
+        state["unread"] += 1
+    state["seen_rev"] = newest
+
+def count_unread(dm, convo_id: str, latest_rev: Optional[str]) -> int:
+    """Local unread count for a conversation, fetching only messages not yet seen (blocking)"""
+    state = get_read_state(convo_id)
+    if latest_rev is not None and state["seen_rev"] == latest_rev:
+        return state["unread"]
+
+    new_messages = []
+    cursor = None
+    while len(new_messages) < UNREAD_MAX_SCAN:
+        response = dm.get_messages(models.ChatBskyConvoGetMessages.Params(
+            convo_id=convo_id, limit=UNREAD_PAGE_SIZE, cursor=cursor
+        ))
+        reached_seen = False
+        for msg in response.messages:
+            rev = getattr(msg, 'rev', None)
+            if state["seen_rev"] and rev and rev <= state["seen_rev"]:
+                reached_seen = True
+                break
+            new_messages.append(msg)
+        cursor = response.cursor
+        if reached_seen or not cursor:
+            break
+
+    note_messages(convo_id, new_messages)
+    index_messages(convo_id, new_messages)
+    return state["unread"]
+
+def fetch_messages(dm, convo_id: str, limit: int) -> list:
+    """Fetch and shape the latest messages of a conversation (blocking)"""
+    logger.info(f"Fetching messages from ATProtocol for conversation {convo_id}")
+    messages_response = dm.get_messages(models.ChatBskyConvoGetMessages.Params(convo_id=convo_id, limit=limit))
+    logger.info(f"Found {len(messages_response.messages)} messages")
+    note_messages(convo_id, messages_response.messages)
+    index_messages(convo_id, messages_response.messages)
+
+    image_infos = marker_image_infos(messages_response.messages)
+    messages = []
+    for msg in messages_response.messages:
+        try:
+            messages.append(shape_message(msg, image_infos))
+        except Exception as e:
+            logger.error(f"Failed to process message {msg.id}: {e}")
+            logger.error(f"Traceback: {traceback.format_exc()}")
+            continue
+    return messages
+
+def parse_timestamp(value: str) -> datetime:
+    """Parse an ISO 8601 timestamp; one without a timezone is taken as UTC"""
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+def parse_since(since: str) -> tuple[str, object, Optional[str]]:
+    """Classify a since value as ("rev", rev, log rev), ("time", datetime, None) or ("id", message ID, None)
+
+    Revs and message IDs are separate opaque values that cannot be ordered
+    against each other, so revs are passed with a "rev:" prefix, which is
+    how delta responses return their cursor. The cursor carries the newest
+    message rev and, after a colon, the chat log position, which advance
+    independently. Raises ValueError for a value that cannot be parsed.
+    """
+    if since.startswith("rev:"):
+        message_rev, _, log_rev = since[4:].partition(":")
+        if not message_rev:
+            raise ValueError(f"Invalid since cursor: {since}")
+        return "rev", message_rev, log_rev or None
+    if "T" in since:
+        # Message IDs are lowercase, so this can only be meant as a timestamp
+        try:
+            return "time", parse_timestamp(since), None
+        except ValueError:
+            raise ValueError(f"Invalid since timestamp: {since}")
+    return "id", since, None
+
+def fetch_deleted_since(dm, convo_id: str, since_rev: str) -> tuple[list, str]:
+    """Messages deleted in a conversation after since_rev, from the chat log (blocking)
+
+    Returns the deleted message IDs and the newest log rev read.
+    """
+    deleted = []
+    cursor = since_rev
+    for _ in range(DELTA_MAX_SCAN // DELTA_PAGE_SIZE):
+        response = dm.get_log(models.ChatBskyConvoGetLog.Params(cursor=cursor))
+        for log in response.logs:
+            if getattr(log, 'py_type', None) == 'chat.bsky.convo.defs#logDeleteMessage' and log.convo_id == convo_id:
+                deleted.append(log.message.id)
+        if not response.logs or not response.cursor or response.cursor == cursor:
+            break
+        cursor = response.cursor
+    return deleted, cursor
+
+def fetch_messages_since(dm, convo_id: str, since: str) -> dict:
+    """Messages newer than `since` plus deletions, paging back only as far as needed (blocking)
+
+    `since` is a message ID, a "rev:" cursor or a sentAt timestamp (see
+    parse_since). The returned cursor holds the newest message rev seen and
+    the chat log position; passing it as the next `since` keeps polls down
+    to what changed. The log is read after the messages, so its position
+    can be ahead of messages created in between; it is kept apart from the
+    message rev so those messages are still returned by the next poll.
+    If `since` is not reached within DELTA_MAX_SCAN messages, or a message
+    ID is not found at all, the result is marked truncated and the client
+    should reload.
+    """
+    kind, value, log_rev = parse_since(since)
+
+    def reached(msg) -> bool:
+        if kind == "time":
+            return parse_timestamp(str(msg.sent_at)) <= value
+        if kind == "rev":
+            return getattr(msg, 'rev', '') <= value
+        return msg.id == value
+
+    new_messages = []
+    deleted = []
+    since_rev = value if kind == "rev" else None
+    truncated = True
+    cursor = None
+    while len(new_messages) + len(deleted) < DELTA_MAX_SCAN:
+        response = dm.get_messages(models.ChatBskyConvoGetMessages.Params(
+            convo_id=convo_id, limit=DELTA_PAGE_SIZE, cursor=cursor
+        ))
+        for msg in response.messages:
+            if reached(msg):
+                if kind == "id":
+                    since_rev = msg.rev
+                truncated = False
+                break
+            if getattr(msg, 'text', None) is None:
+                deleted.append(msg.id)
+            else:
+                new_messages.append(msg)
+        else:
+            cursor = response.cursor
+            if cursor:
+                continue
+            # Reached the start of the history; an unknown message ID means the
+            # client's view cannot be reconciled
+            truncated = kind == "id"
+        break
+
+    note_messages(convo_id, new_messages)
+    index_messages(convo_id, new_messages)
+
+    revs = [msg.rev for msg in new_messages if getattr(msg, 'rev', None)]
+    if since_rev:
+        revs.append(since_rev)
+        # Messages older than `since` can also have been deleted; the log knows about those
+        log_deleted, log_rev = fetch_deleted_since(dm, convo_id, log_rev or since_rev)
+        deleted.extend(message_id for message_id in log_deleted if message_id not in deleted)
+    unindex_messages(deleted)
+
+    next_since = since
+    if revs:
+        next_since = f"rev:{max(revs)}:{log_rev}" if log_rev else f"rev:{max(revs)}"
+    image_infos = marker_image_infos(new_messages)
+    return {
+        "messages": [shape_message(msg, image_infos) for msg in new_messages],
+        "deleted": deleted,
+        "cursor": next_since,
+        "truncated": truncated
+    }
+
+def fetch_conversations(dm) -> tuple[list, dict]:
+    """Fetch and shape the conversation list (blocking)
+
+    Returns the shaped conversations and a map of convo ID to upstream rev,
+    which the warmer uses to detect activity.
+    """
+    logger.info("Fetching conversation list from ATProtocol...")
+    convo_list = dm.list_convos()
+    logger.info(f"Found {len(convo_list.convos)} conversations")
+
+    conversations = []
+    revs = {}
+    # Last messages are indexed together after the loop: one transaction, not one per conversation
+    last_message_rows = []
+    for convo in convo_list.convos:
+        try:
+            # The convo view usually carries the last message already; only
+            # fall back to a get_messages round-trip when it does not
+            last_message = None
+            msg = getattr(convo, 'last_message', None)
+            if msg is None or not hasattr(msg, 'text'):
                 try:
                     logger.info(f"Fetching last message for conversation {convo.id}")
                     messages = dm.get_messages(models.ChatBskyConvoGetMessages.Params(convo_id=convo.id, limit=1))
-                    if messages.messages:
-                        msg = messages.messages[0]
-                        last_message = {
-                            "id": msg.id,
-                            "text": msg.text,
-                            "author": {
-                                "did": msg.sender.did,
-                                "handle": msg.sender.did,
-                                "displayName": getattr(msg.sender, 'displayName', None),
-                                "avatar": getattr(msg.sender, 'avatar', None)
-                            },
-                            "createdAt": msg.sent_at,
-                            "embed": getattr(msg, 'embed', None)
-                        }
-                        logger.info(f"Found last message: {msg.id}")
-                    else:
-                        logger.info(f"No messages found for conversation {convo.id}")
+                    msg = messages.messages[0] if messages.messages else None
                 except Exception as e:
                     logger.warning(f"Failed to get last message for conversation {convo.id}: {e}")
-
-                conversation_data = {
-                    "id": convo.id,
-                    "members": [
-                        {
-                            "did": member.did,
-                            "handle": member.handle,
-                            "displayName": getattr(member, 'displayName', None),
-                            "avatar": getattr(member, 'avatar', None)
-                        }
-                        for member in convo.members
-                    ],
-                    "lastMessage": last_message,
-                    "unreadCount": 0  # TODO: Implement unread count
+                    msg = None
+            if msg is not None and hasattr(msg, 'text'):
+                last_message_rows.extend(search_rows(convo.id, [msg]))
+                last_message = {
+                    "id": msg.id,
+                    "text": msg.text,
+                    "author": shape_author(msg.sender),
+                    "createdAt": msg.sent_at,
+                    "embed": getattr(msg, 'embed', None)
                 }
-                conversations.append(conversation_data)
-                logger.info(f"Successfully processed conversation {convo.id}")
 
+            # Prefer the upstream unread count; fall back to local read cursors
+            unread_count = getattr(convo, 'unread_count', None)
+            if unread_count is None:
+                unread_count = count_unread(dm, convo.id, getattr(convo, 'rev', None))
+            else:
+                get_read_state(convo.id)["unread"] = unread_count
+
+            conversations.append({
+                "id": convo.id,
+                "members": [
+                    {
+                        "did": member.did,
+                        "handle": member.handle,
+                        "displayName": getattr(member, 'displayName', None),
+                        "avatar": getattr(member, 'avatar', None)
+                    }
+                    for member in convo.members
+                ],
+                "lastMessage": last_message,
+                "unreadCount": unread_count
+            })
+            revs[convo.id] = getattr(convo, 'rev', None)
+
+        except Exception as e:
+            logger.error(f"Failed to process conversation {convo.id}: {e}")
+            logger.error(f"Traceback: {traceback.format_exc()}")
+            # Continue processing other conversations
+            continue
+
+    store_search_rows(last_message_rows)
+    logger.info(f"Successfully processed {len(conversations)} conversations")
+    return conversations, revs
+
+def finish_coalesced_read(key: tuple, task: asyncio.Task):
+    """Move a finished read from the in-flight table to the micro-cache"""
+    inflight_reads.pop(key, None)
+    if task.cancelled() or task.exception() is not None:
+        return
+    now = time.monotonic()
+    for stale_key in [k for k, (finished_at, _) in recent_reads.items() if now - finished_at > COALESCE_WINDOW]:
+        del recent_reads[stale_key]
+    recent_reads[key] = (now, task.result())
+
+async def coalesced(key: tuple, fetch):
+    """Run fetch() once for all concurrent callers with the same key
+
+    Callers arriving while a read is in flight await the same task, and
+    callers within COALESCE_WINDOW after it finished get its result. The
+    shaped result is shared, so callers must not mutate it.
+    """
+    recent = recent_reads.get(key)
+    if recent and time.monotonic() - recent[0] <= COALESCE_WINDOW:
+        coalesce_stats["micro_cached"] += 1
+        return recent[1]
+
+    task = inflight_reads.get(key)
+    if task is None:
+        coalesce_stats["upstream"] += 1
+        task = asyncio.ensure_future(fetch())
+        inflight_reads[key] = task
+        task.add_done_callback(lambda done: finish_coalesced_read(key, done))
+    else:
+        coalesce_stats["coalesced"] += 1
+    # Shield so one caller disconnecting does not cancel the read for the others
+    return await asyncio.shield(task)
+
+def retry_after(route: str) -> str:
+    """Seconds a shed client should wait: roughly the time to drain the queue ahead of it"""
+    stats = admission_stats[route]
+    limit = ADMISSION_LIMITS[route][0]
+    seconds = stats["avg_service_ms"] / 1000 * (stats["waiting"] + 1) / limit
+    return str(max(1, math.ceil(seconds)))
+
+@asynccontextmanager
+async def admit(route: str):
+    """Bound the concurrency of an expensive route with a bounded wait queue
+
+    Requests beyond the concurrency limit wait in a queue of limited size;
+    when the queue is full they are rejected with 429, and when they wait
+    longer than ADMISSION_QUEUE_TIMEOUT with 503, both with Retry-After.
+    """
+    limit, queue_size = ADMISSION_LIMITS[route]
+    stats = admission_stats.setdefault(route, {
+        "limit": limit, "queue": queue_size, "active": 0, "waiting": 0,
+        "admitted": 0, "rejected": 0, "timed_out": 0, "avg_service_ms": 0.0
+    })
+    semaphore = admission_semaphores.setdefault(route, asyncio.Semaphore(limit))
+
+    if semaphore.locked() and stats["waiting"] >= queue_size:
+        stats["rejected"] += 1
+        raise HTTPException(status_code=429, detail=f"Too many {route} requests",
+                            headers={"Retry-After": retry_after(route)})
+
+    stats["waiting"] += 1
+    try:
+        await asyncio.wait_for(semaphore.acquire(), ADMISSION_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        stats["timed_out"] += 1
+        raise HTTPException(status_code=503, detail=f"Server busy with {route} requests",
+                            headers={"Retry-After": retry_after(route)})
+    finally:
+        stats["waiting"] -= 1
+
+    stats["active"] += 1
+    stats["admitted"] += 1
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        stats["active"] -= 1
+        semaphore.release()
+        elapsed_ms = (time.monotonic() - started) * 1000
+        stats["avg_service_ms"] = round(0.8 * stats["avg_service_ms"] + 0.2 * elapsed_ms, 1)
+
+def admission(route: str):
+    """Endpoint dependency that runs the whole request under admit(route)"""
+    async def dependency():
+        async with admit(route):
+            yield
+    return dependency
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream method whose circuit is open"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Upstream {name} is unavailable, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+def check_circuit(name: str):
+    """Fail fast if the circuit for an upstream method is open
+
+    After CIRCUIT_RESET_TIMEOUT one trial call is let through (half-open);
+    its outcome closes or re-opens the circuit. Returns True for the trial
+    call. A trial that never reports back expires after UPSTREAM_TIMEOUT.
+    """
+    circuit = circuits.setdefault(name, {"failures": 0, "opened_at": None, "trial": False, "trial_started": 0.0})
+    if circuit["opened_at"] is None:
+        return False
+    now = time.monotonic()
+    remaining = circuit["opened_at"] + CIRCUIT_RESET_TIMEOUT - now
+    trial_running = circuit["trial"] and now - circuit["trial_started"] < UPSTREAM_TIMEOUT
+    if remaining > 0 or trial_running:
+        raise CircuitOpenError(name, max(remaining, 1.0))
+    circuit["trial"] = True
+    circuit["trial_started"] = now
+    return True
+
+def release_trial(name: str):
+    """Let another call be the half-open trial when this one never reached upstream"""
+    circuit = circuits.get(name)
+    if circuit:
+        circuit["trial"] = False
+
+def record_upstream_result(name: str, success: bool):
+    """Update the circuit of an upstream method after a call"""
+    circuit = circuits.setdefault(name, {"failures": 0, "opened_at": None, "trial": False, "trial_started": 0.0})
+    circuit["trial"] = False
+    if success:
+        circuit["failures"] = 0
+        circuit["opened_at"] = None
+        return
+    circuit["failures"] += 1
+    if circuit["opened_at"] is not None or circuit["failures"] >= CIRCUIT_FAILURE_THRESHOLD:
+        if circuit["opened_at"] is None:
+            logger.warning(f"Opening circuit for upstream {name} after {circuit['failures']} failures")
+        circuit["opened_at"] = time.monotonic()
+
+def upstream_status(error: Exception) -> Optional[int]:
+    """HTTP status of the upstream response behind an atproto error, if there was one"""
+    return getattr(getattr(error, 'response', None), 'status_code', None)
+
+def is_upstream_failure(error: Exception) -> bool:
+    """Whether an error says the upstream is unavailable, which is all circuits track
+
+    Rejected requests (4xx, such as an unknown conversation ID) and local
+    bugs say nothing about upstream health; counting them would let any
+    client open a circuit for everyone.
+    """
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    if not isinstance(error, exceptions.RequestErrorBase):
+        return False
+    status = upstream_status(error)
+    if status is None:
+        # Transport errors and timeouts never got a response
+        return isinstance(error, exceptions.NetworkError)
+    return status >= 500
+
+def circuit_is_open(name: str) -> bool:
+    circuit = circuits.get(name)
+    return bool(circuit and circuit["opened_at"] is not None)
+
+async def guarded_fetch(key: tuple, method: str, fetch):
+    """Coalesced upstream read behind the circuit breaker, bounded by UPSTREAM_TIMEOUT
+
+    A successful result is stored in the response cache.
+    """
+    trial = check_circuit(method)
+    attempted = False
+
+    async def fetch_and_store():
+        nonlocal attempted
+        # Only the call that actually goes upstream takes an admission slot
+        async with admit(key[0]):
+            attempted = True
+            try:
+                result = await fetch()
             except Exception as e:
-                logger.error(f"Failed to process conversation {convo.id}: {e}")
-                logger.error(f"Traceback: {traceback.format_exc()}")
-                # Continue processing other conversations
-                continue
+                if is_upstream_failure(e):
+                    record_upstream_result(method, False)
+                else:
+                    release_trial(method)
+                raise
+        record_upstream_result(method, True)
+        response_cache[key] = (time.monotonic(), result)
+        return result
 
-        logger.info(f"Successfully processed {len(conversations)} conversations")
-        return conversations
+    try:
+        return await asyncio.wait_for(coalesced(key, fetch_and_store), UPSTREAM_TIMEOUT)
+    except asyncio.TimeoutError:
+        # The shared upstream call keeps running and can still fill the cache
+        record_upstream_result(method, False)
+        raise
+    finally:
+        if trial and not attempted:
+            # Shed by admission, micro-cached or joined another read: no verdict yet
+            release_trial(method)
 
+async def revalidate(key: tuple, method: str, fetch):
+    """Refresh a cached response in the background, keeping the old one on failure"""
+    try:
+        await guarded_fetch(key, method, fetch)
+    except (CircuitOpenError, HTTPException):
+        # Circuit open or shed by admission control; the next read tries again
+        pass
+    except Exception as e:
+        logger.warning(f"Background revalidation of {key} failed: {e}")
+
+async def cached_read(key: tuple, method: str, fetch, response: Response):
+    """Serve a read endpoint through the stale-while-revalidate cache
+
+    A cached result is returned right away; once older than SWR_FRESH_FOR a
+    background revalidation is started. The X-Cache header reports fresh,
+    revalidating, stale (upstream failing) or miss. Without a cached result
+    the upstream read is awaited, failing fast with 503 while the circuit is
+    open and with 504 after UPSTREAM_TIMEOUT. Requests upstream rejects are
+    answered with its 4xx status.
+    """
+    entry = response_cache.get(key)
+    if entry is not None:
+        stored_at, result = entry
+        age = time.monotonic() - stored_at
+        response.headers["Age"] = str(int(age))
+        if age <= SWR_FRESH_FOR and not circuit_is_open(method):
+            response.headers["X-Cache"] = "fresh"
+            return result
+        # While the circuit is open this only gets through once it is half-open
+        response.headers["X-Cache"] = "stale" if circuit_is_open(method) else "revalidating"
+        if key not in inflight_reads:
+            asyncio.create_task(revalidate(key, method, fetch))
+        return result
+
+    response.headers["X-Cache"] = "miss"
+    try:
+        return await guarded_fetch(key, method, fetch)
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(e.retry_after))})
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"Upstream {method} timed out")
+    except exceptions.RequestErrorBase as e:
+        # Requests upstream rejected are the client's error; auth failures are ours
+        status = upstream_status(e)
+        if status is None or status >= 500 or status in (401, 403):
+            raise
+        content = getattr(e.response, 'content', None)
+        message = getattr(content, 'message', None) or getattr(content, 'error', None) or "request rejected"
+        raise HTTPException(status_code=status, detail=f"Upstream {method}: {message}")
+
+def invalidate_warm_cache(convo_id: Optional[str] = None):
+    """Drop cached data touched by a write and wake the warmer"""
+    if convo_id:
+        warm_cache["messages"].pop(convo_id, None)
+        for key in response_cache.keys():
+            if key[0] == "messages" and key[1] == convo_id:
+                response_cache.pop(key)
+    response_cache.pop(("conversations",), None)
+    recent_reads.clear()
+    warm_cache["conversations_at"] = 0.0
+    warm_cache["interval"] = WARM_INTERVAL_MIN
+    warm_wakeup.set()
+
+async def warm_cache_once(dm):
+    """Refresh the conversation list and the messages of the most active conversations"""
+    conversations, revs = await asyncio.to_thread(fetch_conversations, dm)
+    previous_revs = warm_cache["revs"]
+    now = time.monotonic()
+
+    warm_cache["conversations"] = conversations
+    warm_cache["conversations_at"] = now
+    warm_cache["revs"] = revs
+
+    # Most active = most recent last message; only refetch what changed upstream
+    active = sorted(
+        conversations,
+        key=lambda c: (c["lastMessage"] or {}).get("createdAt") or "",
+        reverse=True
+    )[:WARM_TOP_CONVOS]
+    for convo in active:
+        convo_id = convo["id"]
+        cached = warm_cache["messages"].peek(convo_id)
+        if cached and previous_revs.get(convo_id) == revs.get(convo_id):
+            cached["fetched_at"] = now
+            continue
+        messages = await asyncio.to_thread(fetch_messages, dm, convo_id, WARM_MESSAGE_LIMIT)
+        warm_cache["messages"][convo_id] = {
+            "messages": messages,
+            "limit": WARM_MESSAGE_LIMIT,
+            "fetched_at": now
+        }
+
+    # Forget conversations that dropped out of the active set
+    active_ids = {c["id"] for c in active}
+    for convo_id in warm_cache["messages"].keys():
+        if convo_id not in active_ids:
+            warm_cache["messages"].pop(convo_id)
+
+    return revs != previous_revs
+
+async def warm_cache_loop():
+    """Log in eagerly and keep the warm cache fresh on an adaptive interval
+
+    The interval drops to WARM_INTERVAL_MIN whenever activity is seen and
+    doubles up to WARM_INTERVAL_MAX while conversations stay idle.
+    """
+    logger.info("Starting background cache warmer")
+    while True:
+        try:
+            client, dm = await get_client()
+            changed = await warm_cache_once(dm)
+            if changed:
+                warm_cache["interval"] = WARM_INTERVAL_MIN
+            else:
+                warm_cache["interval"] = min(warm_cache["interval"] * 2, WARM_INTERVAL_MAX)
+            logger.info(f"Warm cache refreshed, next refresh in {warm_cache['interval']:.0f}s")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Warm cache refresh failed: {e}")
+            warm_cache["interval"] = WARM_INTERVAL_MAX
+
+        warm_wakeup.clear()
+        try:
+            await asyncio.wait_for(warm_wakeup.wait(), timeout=warm_cache["interval"])
+        except asyncio.TimeoutError:
+            pass
+
+def get_warm_messages(convo_id: str, limit: int) -> Optional[tuple[float, list]]:
+    """Return (fetched_at, messages) from the warm cache if it covers `limit` and is recent enough"""
+    cached = warm_cache["messages"].get(convo_id)
+    if not cached or limit > cached["limit"]:
+        return None
+    if time.monotonic() - cached["fetched_at"] > WARM_MAX_AGE:
+        return None
+    # Upstream returns newest first, so the latest `limit` messages are a prefix
+    return cached["fetched_at"], cached["messages"][:limit]
+
+def seed_from_warm(key: tuple, fetched_at: float, result):
+    """Offer warm data to the response cache unless it already holds something newer
+
+    Warm data then goes through cached_read like any other entry: served
+    as-is while younger than SWR_FRESH_FOR, revalidated in the background
+    after that.
+    """
+    entry = response_cache.peek(key)
+    if entry is None or entry[0] < fetched_at:
+        response_cache[key] = (fetched_at, result)
+
+@app.get("/")
+async def root():
+    return {"message": "SevenSky Chat API is running!"}
+
+@app.get("/conversations")
+async def get_conversations(response: Response):
+    """Get all conversations for the current user"""
+    try:
+        logger.info("Getting conversations...")
+        # A write resets conversations_at, so the warm list is not offered after one
+        if warm_cache["conversations"] is not None and warm_cache["conversations_at"] and \
+                time.monotonic() - warm_cache["conversations_at"] <= WARM_MAX_AGE:
+            seed_from_warm(("conversations",), warm_cache["conversations_at"], warm_cache["conversations"])
+
+        async def fetch():
+            client, dm = await get_client()
+            conversations, revs = await asyncio.to_thread(fetch_conversations, dm)
+            warm_cache["conversations"] = conversations
+            warm_cache["conversations_at"] = time.monotonic()
+            return conversations
+
+        return await cached_read(("conversations",), "list_convos", fetch, response)
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to get conversations: {e}")
         logger.error(f"Traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Failed to get conversations: {str(e)}")
 
 @app.get("/conversations/{convo_id}/messages")
-async def get_messages(convo_id: str, limit: int = 50):
-    """Get messages for a specific conversation"""
+async def get_messages(convo_id: str, response: Response, limit: int = 50, since: Optional[str] = None):
+    """Get messages for a specific conversation
+
+    With `since` (a message ID, "rev:<rev>" or sentAt timestamp) only the
+    changes are returned: {"messages": newer messages, "deleted": deleted
+    message IDs, "cursor": value to pass as the next since, "truncated": bool}.
+    """
     try:
-        logger.info(f"Getting messages for conversation {convo_id} with limit {limit}")
-        client, dm = await get_client()
+        if since:
+            logger.info(f"Getting messages for conversation {convo_id} since {since}")
+            try:
+                kind, since_rev, _ = parse_since(since)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            # Nothing to fetch if the conversation's rev has not moved past a rev `since`
+            known_rev = warm_cache["revs"].get(convo_id)
+            if kind == "rev" and known_rev and known_rev <= since_rev and \
+                    time.monotonic() - warm_cache["conversations_at"] <= DELTA_REV_MAX_AGE:
+                return {"messages": [], "deleted": [], "cursor": since, "truncated": False}
 
-        logger.info(f"Fetching messages from ATProtocol for conversation {convo_id}")
-        messages_response = dm.get_messages(models.ChatBskyConvoGetMessages.Params(convo_id=convo_id, limit=limit))
-        logger.info(f"Found {len(messages_response.messages)} messages")
+            async def fetch_delta():
+                client, dm = await get_client()
+                return await asyncio.to_thread(fetch_messages_since, dm, convo_id, since)
 
-        messages = []
-        for i, msg in enumerate(messages_response.messages):
-            try:
-                logger.info(f"Processing message {i+1}/{len(messages_response.messages)}: {msg.id}")
-
-                # Check if this message has an associated image
-                embed = getattr(msg, 'embed', None)
-
-                # Check for image blob references in text
-                if "IMAGE_BLOB:" in msg.text:
-                    # Extract blob CID from text - CIDs can be much longer and contain various characters
-                    import re
-                    logger.info(f"Found IMAGE_BLOB in text: {msg.text}")
-                    blob_match = re.search(r'IMAGE_BLOB:([a-z0-9]{59})', msg.text)
-                    if blob_match:
-                        blob_cid = blob_match.group(1)
-                        logger.info(f"Extracted blob CID: {blob_cid}")
-
-                        # Check if we have stored info for this message in database
-                        img_info = get_image_info(msg.id)
-                        if img_info:
-                            # Create embed format that frontend expects
-                            embed = {
-                                "images": [{
-                                    "image": {
-                                        "ref": {"$link": blob_cid},
-                                        "mimeType": img_info["mime_type"],
-                                        "size": img_info["size"]
-                                    },
-                                    "alt": f"Image: {img_info['filename']}",
-                                    "blob_url": img_info["blob_url"]
-                                }]
-                            }
-
-                            # Clean up the text by removing the blob marker
-                            clean_text = re.sub(r'\s*📷 IMAGE_BLOB:[a-z0-9]{59}', '', msg.text).strip()
-                            msg.text = clean_text if clean_text else "📷 Image"
-
-                            logger.info(f"=== EMBED CREATION ===")
-                            logger.info(f"Created embed: {embed}")
-                            logger.info(f"Cleaned text: '{msg.text}'")
-                            logger.info(f"Blob URL to test: {img_info['blob_url']}")
-                            logger.info(f"=== END EMBED CREATION ===")
-
-                            logger.info(f"Successfully processed image for message {msg.id}")
-                        else:
-                            # No database entry found, but we have a blob CID
-                            # This might be a legacy message or database was cleared
-                            logger.warning(f"Found IMAGE_BLOB marker but no database entry for message {msg.id}")
-                            # Clean up the text anyway
-                            clean_text = re.sub(r'\s*📷 IMAGE_BLOB:[a-z0-9]{59}', '', msg.text).strip()
-                            msg.text = clean_text if clean_text else "📷 Image (no metadata)"
-                    else:
-                        logger.warning(f"Could not extract blob CID from: {msg.text}")
+            return await cached_read(("messages", convo_id, "since", since), "get_messages", fetch_delta, response)
 
-                message_data = {
-                    "id": msg.id,
-                    "text": msg.text,
-                    "author": {
-                        "did": msg.sender.did,
-                        "handle": msg.sender.did,
-                        "displayName": getattr(msg.sender, 'displayName', None),
-                        "avatar": getattr(msg.sender, 'avatar', None)
-                    },
-                    "createdAt": msg.sent_at,
-                    "embed": embed
-                }
-                messages.append(message_data)
-                logger.info(f"Successfully processed message {msg.id}")
+        logger.info(f"Getting messages for conversation {convo_id} with limit {limit}")
+        warm = get_warm_messages(convo_id, limit)
+        if warm is not None:
+            seed_from_warm(("messages", convo_id, limit), *warm)
 
-            except Exception as e:
-                logger.error(f"Failed to process message {msg.id}: {e}")
-                logger.error(f"Traceback: {traceback.format_exc()}")
-                continue
+        async def fetch():
+            client, dm = await get_client()
+            return await asyncio.to_thread(fetch_messages, dm, convo_id, limit)
 
+        messages = await cached_read(("messages", convo_id, limit), "get_messages", fetch, response)
         logger.info(f"Successfully processed {len(messages)} messages for conversation {convo_id}")
         return messages
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to get messages for conversation {convo_id}: {e}")
         logger.error(f"Traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Failed to get messages: {str(e)}")
 
+class MarkReadItem(BaseModel):
+    convo_id: str
+    message_id: Optional[str] = None
+
+class MarkReadRequest(BaseModel):
+    conversations: list[MarkReadItem]
+
+async def flush_pending_reads(delay: float = MARK_READ_FLUSH_DELAY):
+    """Send queued mark-read calls upstream, one updateRead per conversation
+
+    If the client cannot be created the batch is queued again and retried
+    with a doubling delay.
+    """
+    global pending_reads, pending_reads_task
+
+    await asyncio.sleep(delay)
+    batch = pending_reads
+    pending_reads = {}
+    pending_reads_task = None
+
+    try:
+        client, dm = await get_client()
+    except Exception as e:
+        # Put the batch back behind anything queued meanwhile and try again later
+        logger.warning(f"Failed to flush {len(batch)} mark-read calls, retrying: {e}")
+        for convo_id, message_id in batch.items():
+            if convo_id not in pending_reads:
+                pending_reads[convo_id] = message_id
+            elif message_id is None:
+                pending_reads[convo_id] = None
+        if pending_reads_task is None:
+            pending_reads_task = asyncio.create_task(flush_pending_reads(min(delay * 2, 60)))
+        return
+
+    async def update_read(convo_id: str, message_id: Optional[str]):
+        try:
+            await asyncio.to_thread(
+                dm.update_read,
+                models.ChatBskyConvoUpdateRead.Data(convo_id=convo_id, message_id=message_id)
+            )
+        except Exception as e:
+            logger.warning(f"Failed to mark conversation {convo_id} as read: {e}")
+
+    logger.info(f"Flushing {len(batch)} mark-read calls")
+    await asyncio.gather(*(update_read(convo_id, message_id) for convo_id, message_id in batch.items()))
+
+@app.post("/conversations/mark-read")
+async def mark_read(request: MarkReadRequest):
+    """Mark conversations as read
+
+    Local unread counts are cleared right away; the upstream updateRead calls
+    are queued and sent together shortly after, so a burst of mark-read
+    requests only costs one call per conversation.
+    """
+    global pending_reads_task
+
+    try:
+        cleared = set()
+        for item in request.conversations:
+            state = await asyncio.to_thread(get_read_state, item.convo_id)
+            if item.message_id is None:
+                state["read_rev"] = state["seen_rev"] or state["read_rev"]
+                state["unread"] = 0
+                cleared.add(item.convo_id)
+            else:
+                rev = message_revs.get(item.message_id)
+                if rev is None:
+                    # Not seen from upstream; the cursor moves once the warmer
+                    # picks up the upstream read state
+                    logger.info(f"Rev of message {item.message_id} unknown, keeping local cursor")
+                elif state["read_rev"] is None or rev > state["read_rev"]:
+                    state["read_rev"] = rev
+                    state["unread"] = 0
+                    if state["seen_rev"] and rev < state["seen_rev"]:
+                        # Messages after it are unread; count them again when next seen
+                        state["seen_rev"] = rev
+                    else:
+                        cleared.add(item.convo_id)
+            await asyncio.to_thread(store_read_cursor, item.convo_id, item.message_id, state["read_rev"])
+
+            # A read without message_id marks everything, so it wins over a specific message
+            if item.convo_id in pending_reads and pending_reads[item.convo_id] is None:
+                continue
+            pending_reads[item.convo_id] = item.message_id
+
+        for convo in warm_cache["conversations"] or []:
+            if convo["id"] in cleared:
+                convo["unreadCount"] = 0
+        # The cached listing still carries the old counts; the next read is seeded from the warm list
+        response_cache.pop(("conversations",), None)
+        recent_reads.pop(("conversations",), None)
+
+        if pending_reads and pending_reads_task is None:
+            pending_reads_task = asyncio.create_task(flush_pending_reads())
+
+        return {"success": True, "queued": len(pending_reads)}
+
+    except Exception as e:
+        logger.error(f"Failed to mark conversations as read: {e}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail=f"Failed to mark conversations as read: {str(e)}")
+
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "100"))
+
+def iter_export_records(dm, convo_id: str, cursor: Optional[str] = None):
+    """Yield export records for a conversation's history, newest first (blocking)
+
+    One page of messages is held in memory at a time. After each page a
+    checkpoint record carries the upstream cursor to resume from.
+    """
+    yield {"type": "export", "convoId": convo_id, "cursor": cursor, "startedAt": time.time()}
+    exported = 0
+    while True:
+        response = dm.get_messages(models.ChatBskyConvoGetMessages.Params(
+            convo_id=convo_id, limit=EXPORT_PAGE_SIZE, cursor=cursor
+        ))
+        image_infos = get_image_infos([
+            msg.id for msg in response.messages if "IMAGE_BLOB:" in (getattr(msg, 'text', None) or "")
+        ])
+        for msg in response.messages:
+            text = getattr(msg, 'text', None)
+            yield {
+                "type": "message",
+                "id": msg.id,
+                "rev": getattr(msg, 'rev', None),
+                "convoId": convo_id,
+                "senderDid": msg.sender.did,
+                "sentAt": str(msg.sent_at),
+                "deleted": text is None,
+                "text": text,
+                "image": image_infos.get(msg.id),
+                "embed": shape_record_embed(msg.embed) if getattr(msg, 'embed', None) else None
+            }
+        exported += len(response.messages)
+        cursor = response.cursor
+        yield {"type": "checkpoint", "cursor": cursor, "exported": exported}
+        if not cursor:
+            break
+
+def iter_export_ndjson(dm, convo_id: str, cursor: Optional[str] = None, compress: bool = False):
+    """Encode export records as NDJSON chunks, optionally as a gzip stream"""
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    for record in iter_export_records(dm, convo_id, cursor):
+        line = (json.dumps(record, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+        if compressor:
+            line = compressor.compress(line)
+            # Flush at checkpoints so everything before a checkpoint is decodable
+            if record["type"] == "checkpoint":
+                line += compressor.flush(zlib.Z_SYNC_FLUSH)
+            if not line:
+                continue
+        yield line
+    if compressor:
+        yield compressor.flush()
+
+@app.get("/conversations/{convo_id}/export")
+async def export_conversation(convo_id: str, cursor: Optional[str] = None, compress: bool = False):
+    """Stream a conversation's full history as NDJSON
+
+    Pass the cursor from the last checkpoint record to resume an interrupted
+    export, and compress=true for a gzip stream.
+    """
+    try:
+        logger.info(f"Exporting conversation {convo_id} (cursor={cursor}, compress={compress})")
+        client, dm = await get_client()
+        headers = {"Content-Disposition": f'attachment; filename="{convo_id}.ndjson{".gz" if compress else ""}"'}
+        return StreamingResponse(
+            iter_export_ndjson(dm, convo_id, cursor, compress),
+            media_type="application/gzip" if compress else "application/x-ndjson",
+            headers=headers
+        )
+
+    except Exception as e:
+        logger.error(f"Failed to export conversation {convo_id}: {e}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail=f"Failed to export conversation: {str(e)}")
+
+@app.get("/search")
+async def search(q: str, convo_id: Optional[str] = None, limit: int = 20):
+    """Full-text search over locally indexed message history"""
+    try:
+        logger.info(f"Searching messages for '{q}' (convo_id={convo_id})")
+        limit = max(1, min(limit, 100))
+        results = await asyncio.to_thread(search_messages, q, convo_id, limit)
+        logger.info(f"Found {len(results)} search results")
+        return results
+
+    except Exception as e:
+        logger.error(f"Failed to search messages: {e}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail=f"Failed to search messages: {str(e)}")
+
+@app.get("/images")
+async def list_images(blob_cid: Optional[str] = None, user_did: Optional[str] = None,
+                      before: Optional[str] = None, limit: int = 50):
+    """Stored image metadata by blob CID or uploader DID, newest first"""
+    if not blob_cid and not user_did:
+        raise HTTPException(status_code=400, detail="Pass blob_cid or user_did")
+    try:
+        limit = max(1, min(limit, 500))
+        return await asyncio.to_thread(find_images, blob_cid, user_did, before, limit)
+
+    except Exception as e:
+        logger.error(f"Failed to list images: {e}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail=f"Failed to list images: {str(e)}")
+
 @app.post("/send-message-with-image")
 async def send_message_with_image(
     convo_id: str = Form(...),
     text: str = Form(...),
-    image: Optional[UploadFile] = File(None)
+    image: Optional[UploadFile] = File(None),
+    _admitted: None = Depends(admission("send"))
 ):
     """Send a message with optional image attachment"""
     try:
@@ -347,8 +2357,9 @@ async def send_message_with_image(
             logger.info(f"Processing image upload: {image.filename}")
             image_data = await image.read()
             logger.info(f"Read {len(image_data)} bytes from image")
+            image_data = await prepare_image(image_data)
 
-            blob = upload_image(client, image_data)
+            blob = await asyncio.to_thread(upload_image, client, image_data)
             logger.info(f"Raw blob object: {blob}")
             logger.info(f"Blob ref type: {type(blob.ref)}")
             logger.info(f"Blob ref value: {blob.ref}")
@@ -358,8 +2369,7 @@ async def send_message_with_image(
             # The blob.ref is an IpldLink object, we need to access the .link property
             blob_cid = blob.ref.link
             current_user_did = client.me.did
-            # Try different blob serving endpoints - bsky.social sometimes has issues
-            blob_url = f"https://cdn.bsky.app/img/feed_fullsize/plain/{current_user_did}/{blob_cid}@jpeg"
+            blob_url = image_blob_url(current_user_did, blob_cid)
 
             logger.info(f"=== BLOB INFO ===")
             logger.info(f"blob_cid: {blob_cid}")
@@ -367,28 +2377,31 @@ async def send_message_with_image(
             logger.info(f"blob_url: {blob_url}")
             logger.info(f"=== END BLOB INFO ===")
 
-            # Add image marker to text
-            original_text = message_data["text"]
-            if not text.strip():
-                message_data["text"] = f"📷 IMAGE_BLOB:{blob_cid}"
+            if IMAGE_EMBED_MODE == "record":
+                message_data["embed"] = await asyncio.to_thread(
+                    create_image_embed, client, blob, image.filename or "Image"
+                )
             else:
-                message_data["text"] = f"{text} 📷 IMAGE_BLOB:{blob_cid}"
+                # Add image marker to text
+                original_text = message_data["text"]
+                message_data["text"] = add_image_marker(text, blob_cid)
 
-            logger.info(f"Text transformation:")
-            logger.info(f"  Original: '{original_text}'")
-            logger.info(f"  Modified: '{message_data['text']}'")
+                logger.info(f"Text transformation:")
+                logger.info(f"  Original: '{original_text}'")
+                logger.info(f"  Modified: '{message_data['text']}'")
             logger.info(f"=== IMAGE PROCESSING END ===")
 
         logger.info("Sending message to ATProtocol...")
-        message = dm.send_message(
+        message = await asyncio.to_thread(
+            dm.send_message,
             models.ChatBskyConvoSendMessage.Data(
                 convo_id=convo_id,
                 message=models.ChatBskyConvoDefs.MessageInput(**message_data)
             )
         )
 
-        # Store image info in database if there was an image
-        if image:
+        # Store image info in database if there was an image sent as a marker
+        if image and "embed" not in message_data:
             logger.info(f"=== DATABASE STORAGE START ===")
             logger.info(f"message.id: {message.id}")
             logger.info(f"blob_cid: {blob_cid}")
@@ -399,7 +2412,8 @@ async def send_message_with_image(
             logger.info(f"user_did: {current_user_did}")
 
             try:
-                store_image_info(
+                await asyncio.to_thread(
+                    store_image_info,
                     message_id=message.id,
                     blob_cid=blob_cid,
                     blob_url=blob_url,
@@ -411,7 +2425,7 @@ async def send_message_with_image(
                 logger.info(f"✅ Successfully stored image info in database for message {message.id}")
 
                 # Verify storage by reading it back
-                stored_info = get_image_info(message.id)
+                stored_info = await asyncio.to_thread(get_image_info, message.id)
                 logger.info(f"✅ Verification - stored info: {stored_info}")
 
             except Exception as e:
@@ -420,14 +2434,171 @@ async def send_message_with_image(
 
             logger.info(f"=== DATABASE STORAGE END ===")
 
+        await asyncio.to_thread(index_messages, convo_id, [message])
+        invalidate_warm_cache(convo_id)
         logger.info(f"Successfully sent message: {message.id}")
         return {"message_id": message.id, "success": True}
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to send message: {e}")
         logger.error(f"Traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Failed to send message: {str(e)}")
 
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "4"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+RATE_LIMIT_MAX_WAIT = 60.0
+
+# Shared pause after an upstream rate limit, so concurrent senders back off together
+rate_limited_until = 0.0
+
+def rate_limit_delay(error: Exception) -> float:
+    """Seconds to wait after a rate limit error, from the ratelimit-reset header when present"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    reset = headers.get('ratelimit-reset')
+    if reset:
+        try:
+            return min(max(0.0, float(reset) - time.time()), RATE_LIMIT_MAX_WAIT)
+        except ValueError:
+            pass
+    return 1.0
+
+async def call_with_rate_limit(func, *args):
+    """Run a blocking upstream call, waiting out and retrying rate limit errors"""
+    global rate_limited_until
+
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        delay = rate_limited_until - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            return await asyncio.to_thread(func, *args)
+        except exceptions.RateLimitExceededError as e:
+            if attempt == BROADCAST_MAX_RETRIES:
+                raise
+            wait = rate_limit_delay(e)
+            logger.warning(f"Rate limited by upstream, backing off for {wait:.1f}s")
+            rate_limited_until = max(rate_limited_until, time.time() + wait)
+
+def resolve_handles(client: Client, handles: list) -> dict:
+    """Resolve handles to DIDs with batched getProfiles calls (blocking)"""
+    resolved = {}
+    for i in range(0, len(handles), 25):
+        batch = handles[i:i + 25]
+        response = client.app.bsky.actor.get_profiles(models.AppBskyActorGetProfiles.Params(actors=batch))
+        for profile in response.profiles:
+            resolved[profile.handle.lower()] = profile.did
+    return resolved
+
+@app.post("/broadcast")
+async def broadcast(
+    text: str = Form(...),
+    convo_ids: list[str] = Form([]),
+    handles: list[str] = Form([]),
+    image: Optional[UploadFile] = File(None),
+    _admitted: None = Depends(admission("broadcast"))
+):
+    """Send one message, with optional image, to many conversations
+
+    The image is uploaded once and the sends fan out with bounded
+    concurrency. Returns a result per target.
+    """
+    try:
+        logger.info(f"Broadcasting to {len(convo_ids)} conversations and {len(handles)} handles")
+        client, dm = await get_client()
+        current_user_did = client.me.did
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+        # Targets in request order, keyed by convo ID; failures are reported per target
+        targets = {convo_id: convo_id for convo_id in dict.fromkeys(convo_ids)}
+        results = []
+
+        if handles:
+            wanted = list(dict.fromkeys(handle.lstrip("@").lower() for handle in handles))
+            resolved = await asyncio.to_thread(resolve_handles, client, wanted)
+
+            async def convo_for(handle: str):
+                user_did = resolved.get(handle)
+                if user_did is None:
+                    results.append({"target": handle, "success": False, "error": "Could not resolve handle"})
+                    return
+                try:
+                    async with semaphore:
+                        response = await call_with_rate_limit(
+                            dm.get_convo_for_members,
+                            models.ChatBskyConvoGetConvoForMembers.Params(members=[current_user_did, user_did])
+                        )
+                    targets.setdefault(response.convo.id, handle)
+                except Exception as e:
+                    results.append({"target": handle, "success": False, "error": str(e)})
+
+            await asyncio.gather(*(convo_for(handle) for handle in wanted))
+
+        message_text = text
+        message_embed = None
+        blob = None
+        image_data = None
+        if image:
+            image_data = await prepare_image(await image.read())
+            logger.info(f"Uploading broadcast image once ({len(image_data)} bytes)")
+            blob = await call_with_rate_limit(upload_image, client, image_data)
+            if IMAGE_EMBED_MODE == "record":
+                # One image post, embedded in every message
+                message_embed = await call_with_rate_limit(
+                    create_image_embed, client, blob, image.filename or "Image"
+                )
+            else:
+                message_text = add_image_marker(text, blob.ref.link)
+
+        async def send(convo_id: str, target: str):
+            try:
+                async with semaphore:
+                    message = await call_with_rate_limit(
+                        dm.send_message,
+                        models.ChatBskyConvoSendMessage.Data(
+                            convo_id=convo_id,
+                            message=models.ChatBskyConvoDefs.MessageInput(
+                                text=message_text,
+                                embed=message_embed
+                            )
+                        )
+                    )
+                return {"target": target, "convo_id": convo_id, "success": True, "message_id": message.id, "message": message}
+            except Exception as e:
+                logger.warning(f"Broadcast to {target} failed: {e}")
+                return {"target": target, "convo_id": convo_id, "success": False, "error": str(e)}
+
+        sent = await asyncio.gather(*(send(convo_id, target) for convo_id, target in targets.items()))
+
+        if blob and message_embed is None:
+            blob_cid = blob.ref.link
+            blob_url = image_blob_url(current_user_did, blob_cid)
+            rows = [
+                (result["message_id"], blob_cid, blob_url, image.filename, blob.mime_type, len(image_data), current_user_did)
+                for result in sent if result["success"]
+            ]
+            await asyncio.to_thread(store_image_infos, rows)
+
+        for result in sent:
+            message = result.pop("message", None)
+            if message is not None:
+                await asyncio.to_thread(index_messages, result["convo_id"], [message])
+                invalidate_warm_cache(result["convo_id"])
+        results.extend(sent)
+
+        failed = sum(1 for result in results if not result["success"])
+        logger.info(f"Broadcast finished: {len(results) - failed} sent, {failed} failed")
+        return {"success": failed == 0, "sent": len(results) - failed, "failed": failed, "results": results}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Failed to broadcast message: {e}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail=f"Failed to broadcast message: {str(e)}")
+
 @app.post("/create-conversation")
 async def create_conversation(user_handle: str):
     """Create a new conversation with a user"""
@@ -437,8 +2608,10 @@ async def create_conversation(user_handle: str):
 
         # Resolve the user handle to DID
         logger.info(f"Resolving handle {user_handle} to DID...")
-        id_resolver = IdResolver()
-        user_did = id_resolver.handle.resolve(user_handle)
+        user_did = (await asyncio.to_thread(
+            client.com.atproto.identity.resolve_handle,
+            models.ComAtprotoIdentityResolveHandle.Params(handle=user_handle)
+        )).did
         logger.info(f"Resolved {user_handle} to {user_did}")
 
         # Get current user DID
@@ -447,11 +2620,12 @@ async def create_conversation(user_handle: str):
 
         # Create or get conversation between the two users
         logger.info("Creating/getting conversation...")
-        convo = dm.get_convo_for_members(
+        convo = (await asyncio.to_thread(
+            dm.get_convo_for_members,
             models.ChatBskyConvoGetConvoForMembers.Params(
                 members=[current_user_did, user_did]
             )
-        ).convo
+        )).convo
 
         logger.info(f"Successfully created/got conversation: {convo.id}")
         return {"convo_id": convo.id, "success": True}
@@ -461,32 +2635,244 @@ async def create_conversation(user_handle: str):
         logger.error(f"Traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Failed to create conversation: {str(e)}")
 
+def fetch_profile(client: Client) -> dict:
+    """Fetch and shape the current user's profile (blocking)"""
+    logger.info(f"Fetching profile for user: {USERNAME}")
+    profile = client.app.bsky.actor.get_profile({"actor": USERNAME})
+
+    return {
+        "did": profile.did,
+        "handle": profile.handle,
+        "displayName": getattr(profile, 'displayName', None),
+        "avatar": getattr(profile, 'avatar', None),
+        "description": getattr(profile, 'description', None)
+    }
+
 @app.get("/profile")
-async def get_profile():
+async def get_profile(response: Response):
     """Get current user profile"""
     try:
         logger.info("Getting current user profile...")
-        client, dm = await get_client()
 
-        logger.info(f"Fetching profile for user: {USERNAME}")
-        profile = client.app.bsky.actor.get_profile({"actor": USERNAME})
-
-        profile_data = {
-            "did": profile.did,
-            "handle": profile.handle,
-            "displayName": getattr(profile, 'displayName', None),
-            "avatar": getattr(profile, 'avatar', None),
-            "description": getattr(profile, 'description', None)
-        }
+        async def fetch():
+            client, dm = await get_client()
+            return await asyncio.to_thread(fetch_profile, client)
 
-        logger.info(f"Successfully retrieved profile: {profile.handle}")
+        profile_data = await cached_read(("profile",), "get_profile", fetch, response)
+        logger.info(f"Successfully retrieved profile: {profile_data['handle']}")
         return profile_data
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to get profile: {e}")
         logger.error(f"Traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Failed to get profile: {str(e)}")
 
+@app.get("/admin/stats")
+async def admin_stats():
+    """Upstream connection reuse, coalescing, circuit breaker, admission, cache and image store statistics"""
+    return {
+        "http": get_http_stats(),
+        "caches": cache_budget.get_stats(),
+        "coalescing": coalesce_stats,
+        "circuits": circuits,
+        "admission": admission_stats,
+        "image_store": await asyncio.to_thread(get_image_store_stats)
+    }
+
+def export_cli(argv: list) -> int:
+    """Export a conversation to an NDJSON file, resuming from its checkpoint file if present
+
+    Usage: python main.py export <convo_id> [--output FILE] [--gzip]
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="main.py export", description="Export a conversation as NDJSON")
+    parser.add_argument("convo_id")
+    parser.add_argument("--output", help="Output file (default: <convo_id>.ndjson[.gz])")
+    parser.add_argument("--gzip", action="store_true", help="Compress the output with gzip")
+    args = parser.parse_args(argv)
+
+    output = args.output or f"{args.convo_id}.ndjson{'.gz' if args.gzip else ''}"
+    checkpoint_path = f"{output}.cursor"
+    cursor = None
+    offset = 0
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            saved_cursor, saved_offset = (f.read().split("\n") + [""])[:2]
+        cursor = saved_cursor or None
+        offset = int(saved_offset or 0)
+        logger.info(f"Resuming export of {args.convo_id} from cursor {cursor}")
+
+    client, dm = asyncio.run(get_client())
+    compressor = zlib.compressobj(wbits=31) if args.gzip else None
+    # Resuming drops anything written after the last checkpoint and appends from there;
+    # a resumed gzip export becomes a multi-member gzip file
+    with open(output, "r+b" if cursor else "wb") as out:
+        out.truncate(offset)
+        out.seek(offset)
+        for record in iter_export_records(dm, args.convo_id, cursor):
+            if record["type"] == "export" and cursor:
+                continue
+            line = (json.dumps(record, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+            out.write(compressor.compress(line) if compressor else line)
+            if record["type"] == "checkpoint":
+                if compressor:
+                    out.write(compressor.flush())
+                    compressor = zlib.compressobj(wbits=31)
+                out.flush()
+                os.fsync(out.fileno())
+                with open(checkpoint_path, "w") as f:
+                    f.write(f"{record['cursor'] or ''}\n{out.tell()}")
+                logger.info(f"Exported {record['exported']} messages")
+
+    os.remove(checkpoint_path)
+    logger.info(f"Finished export of {args.convo_id} to {output}")
+    return 0
+
+def fetch_blob_metadata(blob_url: str) -> tuple[str, int]:
+    """Content type and length of an image blob as served from blob_url (blocking)"""
+    http = get_http_client()
+    response = http.head(blob_url)
+    if response.status_code == 405 or "content-length" not in response.headers:
+        response = http.get(blob_url)
+        response.raise_for_status()
+        size = len(response.content)
+    else:
+        response.raise_for_status()
+        size = int(response.headers["content-length"])
+    mime_type = response.headers.get("content-type", "").split(";")[0].strip()
+    if not mime_type.startswith("image/"):
+        raise ValueError(f"{blob_url} is not an image ({mime_type or 'no content type'})")
+    return mime_type, size
+
+def backfill_marker_images(dm, convo_id: str) -> int:
+    """Record metadata for legacy IMAGE_BLOB messages missing from message_images (blocking)
+
+    The content type and size come from the blob itself; the original
+    filename is not recoverable and stays NULL. Blobs that cannot be fetched
+    are skipped so a later run can retry them. Returns the number of rows added.
+    """
+    added = 0
+    cursor = None
+    while True:
+        response = dm.get_messages(models.ChatBskyConvoGetMessages.Params(
+            convo_id=convo_id, limit=EXPORT_PAGE_SIZE, cursor=cursor
+        ))
+        known = marker_image_infos(response.messages)
+        rows = []
+        for msg in response.messages:
+            if msg.id in known or getattr(msg, 'embed', None) is not None:
+                continue
+            blob_match = re.search(r'IMAGE_BLOB:([a-z0-9]{59})', getattr(msg, 'text', None) or "")
+            if blob_match:
+                blob_cid = blob_match.group(1)
+                blob_url = image_blob_url(msg.sender.did, blob_cid)
+                try:
+                    mime_type, size = fetch_blob_metadata(blob_url)
+                except (httpx.HTTPError, ValueError) as e:
+                    logger.warning(f"Skipping image of message {msg.id}: {e}")
+                    continue
+                rows.append((msg.id, blob_cid, blob_url, None, mime_type, size, msg.sender.did))
+        store_image_infos(rows)
+        added += len(rows)
+        cursor = response.cursor
+        if not cursor:
+            return added
+
+def backfill_cli(argv: list) -> int:
+    """Backfill message_images for legacy marker messages
+
+    Usage: python main.py backfill-images [convo_id ...]  (default: all conversations)
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="main.py backfill-images", description="Backfill legacy image metadata")
+    parser.add_argument("convo_ids", nargs="*")
+    args = parser.parse_args(argv)
+
+    client, dm = asyncio.run(get_client())
+    convo_ids = args.convo_ids or [convo.id for convo in dm.list_convos().convos]
+    for convo_id in convo_ids:
+        added = backfill_marker_images(dm, convo_id)
+        logger.info(f"Backfilled {added} image rows for conversation {convo_id}")
+    return 0
+
+def read_image_rows(path: str):
+    """Image metadata rows from an NDJSON file
+
+    Lines are either flat message_images rows or message records from an
+    export, whose `image` object is used.
+    """
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "type" in record:
+                if record["type"] != "message" or not record.get("image"):
+                    continue
+                image = dict(record["image"], message_id=record["id"], created_at=None)
+            else:
+                image = record
+            if not image.get("blob_cid"):
+                continue
+            yield (
+                image["message_id"], image["blob_cid"],
+                image.get("blob_url") or image_blob_url(image.get("user_did"), image["blob_cid"]),
+                image.get("filename"), image.get("mime_type"), image.get("size"),
+                image.get("user_did"), image.get("created_at")
+            )
+
+def import_images_cli(argv: list) -> int:
+    """Bulk-import image metadata from NDJSON files
+
+    Usage: python main.py import-images FILE [FILE ...] [--batch-size N]
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="main.py import-images", description="Bulk-import image metadata")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--batch-size", type=int, default=IMAGE_IMPORT_BATCH)
+    args = parser.parse_args(argv)
+
+    for path in args.files:
+        imported = import_image_rows(read_image_rows(path), batch_size=args.batch_size)
+        logger.info(f"Imported {imported} image rows from {path}")
+    return 0
+
+def compact_cli(argv: list) -> int:
+    """Apply image metadata retention and compact the database
+
+    Databases created without incremental auto-vacuum are switched over on
+    the first run, with a full VACUUM.
+
+    Usage: python main.py compact-images [--retention-days N]
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="main.py compact-images", description="Compact the image store")
+    parser.add_argument("--retention-days", type=int, default=IMAGE_RETENTION_DAYS,
+                        help="Drop rows older than this many days (0 keeps everything)")
+    args = parser.parse_args(argv)
+
+    result = compact_image_store(retention_days=args.retention_days, enable_auto_vacuum=True)
+    logger.info(f"Compacted image store: {result}")
+    return 0
+
+COMMANDS = {
+    "export": export_cli,
+    "backfill-images": backfill_cli,
+    "import-images": import_images_cli,
+    "compact-images": compact_cli,
+}
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        configure_logging()
+        init_database()
+        sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
+
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
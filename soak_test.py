@@ -0,0 +1,799 @@
+"""Soak test for the SevenSky backend
+
+Replays a mixed read/write workload against the app for a long time while
+sampling RSS, tracemalloc and open file descriptors. atproto is pointed at a
+fake upstream served from a child process, so no real account is touched and
+the upstream's own memory stays out of the measurements. A JSON report is
+written at the end, and the exit code is 1 when growth after the warmup
+passes the thresholds, e.g.:
+
+    uv run python soak_test.py --duration 7200 --report soak_report.json
+
+A short smoke run: `--duration 120 --warmup 30 --sample-interval 10`.
+"""
+import argparse
+import asyncio
+import base64
+import gc
+import hashlib
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SOAK_HANDLE = "soak.test"
+SOAK_DID = "did:plc:soaktestself"
+
+# 1x1 PNG used for image sends
+TINY_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+)
+
+BROADCAST_TEXT = "soak broadcast"
+
+WORDS = "hello lunch meeting tomorrow photo weekend coffee deploy release train café naïve update".split()
+
+# ---------------------------------------------------------------------------
+# Fake upstream
+# ---------------------------------------------------------------------------
+
+class RateLimited(Exception):
+    """Raised by a fake XRPC method to answer 429 with a ratelimit-reset header"""
+
+def did_for(handle: str) -> str:
+    if handle == SOAK_HANDLE:
+        return SOAK_DID
+    return "did:plc:" + hashlib.sha256(handle.encode()).hexdigest()[:24]
+
+def fake_jwt(did: str, scope: str) -> str:
+    """Unsigned JWT that atproto can decode for its expiry checks"""
+    def part(data: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b"=").decode()
+    now = int(time.time())
+    return ".".join([
+        part({"alg": "none", "typ": "JWT"}),
+        part({"sub": did, "scope": scope, "iat": now, "exp": now + 10 * 365 * 86400}),
+        "sig"
+    ])
+
+class FakeUpstream:
+    """In-memory PDS and chat service answering the XRPC calls the backend makes
+
+    Conversations receive new messages as the backend sends them; a small
+    share of sends also deletes an older message so the chat log has entries.
+    History per conversation is capped to keep the fake itself bounded.
+    """
+
+    HISTORY_CAP = 2000
+    LOG_CAP = 10000
+
+    def __init__(self, convos: int, history: int, delete_ratio: float, seed: int,
+                 rate_limit_ratio: float = 0.0):
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.delete_ratio = delete_ratio
+        self.rate_limit_ratio = rate_limit_ratio
+        self.rev = 0
+        self.blobs = 0
+        self.log = []
+        self.convos = {}
+        for i in range(convos):
+            convo = self.add_convo(f"friend{i}.test")
+            for _ in range(history):
+                self.add_message(convo, self.random_text(), convo["member"]["did"])
+
+    def next_rev(self) -> str:
+        self.rev += 1
+        return f"{self.rev:013d}"
+
+    def random_text(self) -> str:
+        return " ".join(self.random.choices(WORDS, k=self.random.randint(2, 12)))
+
+    def profile(self, actor: str) -> dict:
+        handle = SOAK_HANDLE if actor == SOAK_DID else actor
+        return {"did": did_for(handle), "handle": handle, "displayName": handle.split(".")[0].title()}
+
+    def add_convo(self, handle: str) -> dict:
+        convo = {
+            "id": f"convo{len(self.convos):05d}",
+            "rev": self.next_rev(),
+            "member": self.profile(handle),
+            "messages": [],  # oldest first
+            "unread": 0,
+        }
+        self.convos[convo["id"]] = convo
+        return convo
+
+    def add_message(self, convo: dict, text: str, sender_did: str, embed=None) -> dict:
+        rev = self.next_rev()
+        message = {
+            "$type": "chat.bsky.convo.defs#messageView",
+            "id": f"msg{rev}",
+            "rev": rev,
+            "text": text,
+            "sender": {"did": sender_did},
+            "sentAt": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+        }
+        if embed:
+            message["embed"] = embed
+        convo["messages"].append(message)
+        del convo["messages"][:-self.HISTORY_CAP]
+        convo["rev"] = rev
+        if sender_did != SOAK_DID:
+            convo["unread"] += 1
+        return message
+
+    def delete_random_message(self, convo: dict):
+        if len(convo["messages"]) < 2:
+            return
+        message = convo["messages"].pop(self.random.randrange(len(convo["messages"]) - 1))
+        rev = self.next_rev()
+        self.log.append({
+            "$type": "chat.bsky.convo.defs#logDeleteMessage",
+            "rev": rev,
+            "convoId": convo["id"],
+            "message": {
+                "$type": "chat.bsky.convo.defs#deletedMessageView",
+                "id": message["id"],
+                "rev": rev,
+                "sender": message["sender"],
+                "sentAt": message["sentAt"],
+            },
+        })
+        del self.log[:-self.LOG_CAP]
+        convo["rev"] = rev
+
+    def convo_view(self, convo: dict) -> dict:
+        view = {
+            "id": convo["id"],
+            "rev": convo["rev"],
+            "members": [self.profile(SOAK_DID), convo["member"]],
+            "muted": False,
+            "unreadCount": convo["unread"],
+        }
+        if convo["messages"]:
+            view["lastMessage"] = convo["messages"][-1]
+        return view
+
+    def handle(self, method: str, params: dict, body) -> dict:
+        """Answer one XRPC call; raises KeyError for unknown methods"""
+        with self.lock:
+            return getattr(self, "xrpc_" + method.replace(".", "_"))(params, body)
+
+    def xrpc_com_atproto_server_createSession(self, params, body):
+        return {
+            "accessJwt": fake_jwt(SOAK_DID, "com.atproto.access"),
+            "refreshJwt": fake_jwt(SOAK_DID, "com.atproto.refresh"),
+            "handle": SOAK_HANDLE,
+            "did": SOAK_DID,
+        }
+
+    xrpc_com_atproto_server_refreshSession = xrpc_com_atproto_server_createSession
+
+    def xrpc_app_bsky_actor_getProfile(self, params, body):
+        return self.profile(params["actor"][0])
+
+    def xrpc_app_bsky_actor_getProfiles(self, params, body):
+        return {"profiles": [self.profile(actor) for actor in params.get("actors", [])]}
+
+    def xrpc_com_atproto_identity_resolveHandle(self, params, body):
+        return {"did": did_for(params["handle"][0])}
+
+    def xrpc_chat_bsky_convo_listConvos(self, params, body):
+        convos = sorted(self.convos.values(), key=lambda convo: convo["rev"], reverse=True)
+        return {"convos": [self.convo_view(convo) for convo in convos]}
+
+    def xrpc_chat_bsky_convo_getMessages(self, params, body):
+        convo = self.convos[params["convoId"][0]]
+        limit = int(params.get("limit", ["50"])[0])
+        offset = int(params.get("cursor", ["0"])[0])
+        newest_first = convo["messages"][::-1]
+        page = newest_first[offset:offset + limit]
+        response = {"messages": page}
+        if offset + limit < len(newest_first):
+            response["cursor"] = str(offset + limit)
+        return response
+
+    def xrpc_chat_bsky_convo_getLog(self, params, body):
+        cursor = params.get("cursor", [""])[0]
+        logs = [log for log in self.log if log["rev"] > cursor][:100]
+        return {"logs": logs, "cursor": logs[-1]["rev"] if logs else cursor}
+
+    def xrpc_chat_bsky_convo_sendMessage(self, params, body):
+        convo = self.convos[body["convoId"]]
+        # Broadcast fan-out is what trips upstream rate limits; the backend must retry
+        if body["message"]["text"] == BROADCAST_TEXT and self.random.random() < self.rate_limit_ratio:
+            raise RateLimited()
+        message = self.add_message(convo, body["message"]["text"], SOAK_DID, body["message"].get("embed"))
+        # Someone answers now and then, so unread counts and deltas move
+        if self.random.random() < 0.5:
+            self.add_message(convo, self.random_text(), convo["member"]["did"])
+        if self.random.random() < self.delete_ratio:
+            self.delete_random_message(convo)
+        return message
+
+    def xrpc_chat_bsky_convo_updateRead(self, params, body):
+        convo = self.convos[body["convoId"]]
+        convo["unread"] = 0
+        return {"convo": self.convo_view(convo)}
+
+    def xrpc_chat_bsky_convo_getConvoForMembers(self, params, body):
+        other = next(did for did in params["members"] if did != SOAK_DID)
+        for convo in self.convos.values():
+            if convo["member"]["did"] == other:
+                break
+        else:
+            convo = self.add_convo(other)
+        return {"convo": self.convo_view(convo)}
+
+    def xrpc_com_atproto_repo_uploadBlob(self, params, body):
+        self.blobs += 1
+        digest = hashlib.sha256(body + str(self.blobs).encode()).digest()
+        cid = "bafkrei" + base64.b32encode(digest).decode().lower().rstrip("=")[:52]
+        return {"blob": {"$type": "blob", "ref": {"$link": cid}, "mimeType": "image/jpeg", "size": len(body)}}
+
+def serve_upstream(port: int, args) -> None:
+    """Run the fake upstream until killed"""
+    upstream = FakeUpstream(args.convos, args.history, args.delete_ratio, args.seed, args.rate_limit_ratio)
+    latency = args.upstream_latency / 1000
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *log_args):
+            pass
+
+        def respond(self, status: int, payload: dict, headers: dict = None):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def dispatch(self, body):
+            url = urlparse(self.path)
+            method = url.path.rsplit("/", 1)[-1]
+            if latency:
+                time.sleep(latency)
+            try:
+                self.respond(200, upstream.handle(method, parse_qs(url.query), body))
+            except RateLimited:
+                self.respond(429, {"error": "RateLimitExceeded", "message": "Rate Limit Exceeded"},
+                             {"ratelimit-reset": f"{time.time() + 0.2:.3f}"})
+            except (KeyError, AttributeError) as e:
+                self.respond(400, {"error": "InvalidRequest", "message": f"{method}: {e}"})
+
+        def do_GET(self):
+            self.dispatch(None)
+
+        def do_POST(self):
+            raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            is_json = (self.headers.get("Content-Type") or "").startswith("application/json")
+            self.dispatch(json.loads(raw or b"{}") if is_json else raw)
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_upstream(args) -> tuple[subprocess.Popen, str]:
+    """Spawn the fake upstream and wait until it accepts connections"""
+    port = free_port()
+    upstream = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve-upstream", str(port),
+         "--convos", str(args.convos), "--history", str(args.history),
+         "--delete-ratio", str(args.delete_ratio), "--seed", str(args.seed),
+         "--rate-limit-ratio", str(args.rate_limit_ratio),
+         "--upstream-latency", str(args.upstream_latency)],
+        cwd=SCRIPT_DIR
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if upstream.poll() is not None:
+            raise RuntimeError(f"Fake upstream exited with code {upstream.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return upstream, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.05)
+    upstream.kill()
+    raise TimeoutError("Fake upstream did not start")
+
+# ---------------------------------------------------------------------------
+# Workload
+# ---------------------------------------------------------------------------
+
+class Workload:
+    """Mixed traffic resembling a handful of open clients"""
+
+    PROBE_RATIO = 0.3
+
+    MIX = {
+        "conversations": 25,
+        "messages": 20,
+        "poll": 20,
+        "search": 5,
+        "profile": 5,
+        "mark_read": 6,
+        "send": 6,
+        "send_image": 3,
+        "images": 3,
+        "export": 1,
+        "broadcast": 1,
+        "create_conversation": 1,
+        "stats": 4,
+    }
+
+    def __init__(self, http, seed: int):
+        self.http = http
+        self.random = random.Random(seed)
+        self.convo_ids = []
+        self.cursors = {}  # convo_id -> since cursor for delta polls
+        self.seen = {}  # convo_id -> message IDs received, oldest first
+        self.probes = 0
+        self.blob_cids = deque(maxlen=100)
+
+    def pick_convo(self) -> str:
+        return self.random.choice(self.convo_ids)
+
+    async def run(self, name: str):
+        if not self.convo_ids and name not in ("profile", "stats"):
+            name = "conversations"
+        return name, await getattr(self, name)()
+
+    async def conversations(self):
+        response = await self.http.get("/conversations")
+        if response.status_code == 200:
+            self.convo_ids = [convo["id"] for convo in response.json()]
+        return response
+
+    async def messages(self):
+        return await self.http.get(f"/conversations/{self.pick_convo()}/messages",
+                                   params={"limit": self.random.choice([20, 50, 100])})
+
+    async def poll(self):
+        """Delta poll, checked against what the client already has
+
+        Now and then a probe message is sent first; a delta computed after it
+        (not served from cache) must contain it, and no delta may repeat a
+        message the client already received.
+        """
+        convo_id = self.pick_convo()
+        since = self.cursors.get(convo_id)
+        if since is None:
+            response = await self.http.get(f"/conversations/{convo_id}/messages", params={"limit": 20})
+            if response.status_code == 200 and response.json():
+                # Start from a message ID, as a client that just loaded a page would
+                self.cursors[convo_id] = response.json()[0]["id"]
+                self.seen[convo_id] = dict.fromkeys(message["id"] for message in response.json())
+            return response
+
+        probe = None
+        if self.random.random() < self.PROBE_RATIO:
+            self.probes += 1
+            probe = f"probe {id(self)}-{self.probes}"
+            sent = await self.http.post("/send-message-with-image", data={"convo_id": convo_id, "text": probe})
+            if sent.status_code != 200:
+                probe = None
+
+        response = await self.http.get(f"/conversations/{convo_id}/messages", params={"since": since})
+        if response.status_code != 200:
+            return response
+        delta = response.json()
+        if delta["truncated"]:
+            self.cursors.pop(convo_id)
+            return response
+        seen = self.seen.setdefault(convo_id, {})
+        repeated = [message["id"] for message in delta["messages"] if message["id"] in seen]
+        if repeated:
+            response.soak_mismatch = f"delta since {since} repeated {repeated[:3]}"
+        elif probe and response.headers.get("X-Cache") == "miss" and \
+                not any(message["text"] == probe for message in delta["messages"]):
+            response.soak_mismatch = f"delta since {since} is missing the probe message sent just before"
+        for message in delta["messages"]:
+            seen[message["id"]] = None
+        for message_id in delta["deleted"]:
+            seen.pop(message_id, None)
+        while len(seen) > 500:
+            seen.pop(next(iter(seen)))
+        self.cursors[convo_id] = delta["cursor"]
+        return response
+
+    async def search(self):
+        return await self.http.get("/search", params={"q": self.random.choice(WORDS)})
+
+    async def profile(self):
+        return await self.http.get("/profile")
+
+    async def mark_read(self):
+        chosen = self.random.sample(self.convo_ids, min(len(self.convo_ids), self.random.randint(1, 3)))
+        return await self.http.post("/conversations/mark-read",
+                                    json={"conversations": [{"convo_id": convo_id} for convo_id in chosen]})
+
+    async def send(self):
+        return await self.http.post("/send-message-with-image", data={
+            "convo_id": self.pick_convo(),
+            "text": " ".join(self.random.choices(WORDS, k=self.random.randint(1, 20)))
+        })
+
+    async def send_image(self):
+        return await self.http.post(
+            "/send-message-with-image",
+            data={"convo_id": self.pick_convo(), "text": self.random.choice(WORDS)},
+            files={"image": ("soak.png", TINY_PNG, "image/png")}
+        )
+
+    async def images(self):
+        if self.blob_cids and self.random.random() < 0.5:
+            return await self.http.get("/images", params={"blob_cid": self.random.choice(self.blob_cids)})
+        response = await self.http.get("/images", params={"user_did": SOAK_DID, "limit": 20})
+        if response.status_code == 200:
+            self.blob_cids.extend(image["blob_cid"] for image in response.json())
+        return response
+
+    async def export(self):
+        return await self.http.get(f"/conversations/{self.pick_convo()}/export",
+                                   params={"compress": self.random.choice(["true", "false"])})
+
+    async def broadcast(self):
+        """Broadcast to a few conversations; the upstream rate-limits some sends, which must be retried"""
+        chosen = self.random.sample(self.convo_ids, min(len(self.convo_ids), 5))
+        response = await self.http.post("/broadcast", data={"text": BROADCAST_TEXT, "convo_ids": chosen})
+        if response.status_code == 200:
+            failed = [result for result in response.json()["results"] if not result["success"]]
+            if failed:
+                response.soak_mismatch = f"broadcast failed for {len(failed)} targets: {failed[0]['error']}"
+        return response
+
+    async def create_conversation(self):
+        # A bounded pool of handles, so the upstream does not grow without end
+        return await self.http.post("/create-conversation",
+                                    params={"user_handle": f"stranger{self.random.randrange(20)}.test"})
+
+    async def stats(self):
+        return await self.http.get("/admin/stats")
+
+class RouteStats:
+    """Request outcome counts and a bounded latency sample per workload item"""
+
+    def __init__(self):
+        self.routes = {}
+
+    def record(self, name: str, status: int, elapsed: float, mismatch: str = None):
+        route = self.routes.setdefault(name, {
+            "ok": 0, "shed": 0, "errors": 0, "mismatches": 0, "latencies": deque(maxlen=5000)
+        })
+        if mismatch:
+            route["mismatches"] += 1
+            print(f"soak: {name} returned wrong data: {mismatch}", file=sys.stderr)
+        elif status < 400:
+            route["ok"] += 1
+        elif status in (429, 503, 504):
+            route["shed"] += 1
+        else:
+            route["errors"] += 1
+        route["latencies"].append(elapsed)
+
+    def total(self, key: str) -> int:
+        return sum(route[key] for route in self.routes.values())
+
+    def summary(self) -> dict:
+        def percentile(values, fraction):
+            ordered = sorted(values)
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000, 1) if ordered else None
+
+        return {
+            name: {
+                "ok": route["ok"],
+                "shed": route["shed"],
+                "errors": route["errors"],
+                "mismatches": route["mismatches"],
+                "p50_ms": percentile(route["latencies"], 0.5),
+                "p99_ms": percentile(route["latencies"], 0.99),
+            }
+            for name, route in sorted(self.routes.items())
+        }
+
+# ---------------------------------------------------------------------------
+# Sampling
+# ---------------------------------------------------------------------------
+
+def current_rss() -> int:
+    """Resident set size in bytes (peak RSS where the current value is unavailable)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+def open_fds(database_path: str) -> tuple[int, int]:
+    """Open file descriptors, and how many of them point at the SQLite database"""
+    fd_dir = "/proc/self/fd" if os.path.isdir("/proc/self/fd") else "/dev/fd"
+    total = database = 0
+    for name in os.listdir(fd_dir):
+        try:
+            target = os.readlink(os.path.join(fd_dir, name))
+        except OSError:
+            continue
+        total += 1
+        if target.startswith(database_path):
+            database += 1
+    return total, database
+
+def global_sizes(main) -> dict:
+    """Sizes of the backend's long-lived module-level structures"""
+    return {
+        "cache_bytes": main.cache_budget.get_stats()["used_bytes"],
+        "response_cache": len(main.response_cache),
+        "image_cache": len(main.image_cache),
+        "recent_reads": len(main.recent_reads),
+        "inflight_reads": len(main.inflight_reads),
+        "warm_messages": len(main.warm_cache["messages"]),
+        "dns_cache": len(main.dns_cache),
+        "read_state": len(main.read_state),
+        "message_revs": len(main.message_revs),
+        "pending_reads": len(main.pending_reads),
+        "circuits": len(main.circuits),
+        "asyncio_tasks": len(asyncio.all_tasks()),
+        "threads": threading.active_count(),
+        "gc_objects": len(gc.get_objects()),
+    }
+
+def take_sample(main, started: float, stats: RouteStats) -> dict:
+    fds, database_fds = open_fds(os.path.realpath(main.DATABASE_PATH))
+    traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+    return {
+        "elapsed": round(time.monotonic() - started, 1),
+        "rss": current_rss(),
+        "traced": traced,
+        "fds": fds,
+        "database_fds": database_fds,
+        "requests": sum(stats.total(key) for key in ("ok", "shed", "errors", "mismatches")),
+        "errors": stats.total("errors"),
+        "globals": global_sizes(main),
+    }
+
+def growth(samples: list, key: str, window: int = 3) -> float:
+    """Median of the last `window` samples minus the median of the first `window`"""
+    values = [sample[key] for sample in samples if sample[key] is not None]
+    if len(values) < 2:
+        return 0
+    window = max(1, min(window, len(values) // 2))
+    return statistics.median(values[-window:]) - statistics.median(values[:window])
+
+def slope_per_hour(samples: list, key: str) -> float:
+    """Least-squares growth rate of `key` per hour"""
+    points = [(sample["elapsed"], sample[key]) for sample in samples if sample[key] is not None]
+    if len(points) < 2:
+        return 0.0
+    mean_t = statistics.fmean(t for t, _ in points)
+    mean_v = statistics.fmean(v for _, v in points)
+    spread = sum((t - mean_t) ** 2 for t, _ in points)
+    if not spread:
+        return 0.0
+    return sum((t - mean_t) * (v - mean_v) for t, v in points) / spread * 3600
+
+def top_allocators(baseline, final, limit: int) -> list:
+    """Source lines whose live allocations grew the most since the baseline"""
+    ignore = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ]
+    stats = final.filter_traces(ignore).compare_to(baseline.filter_traces(ignore), "lineno")
+    return [
+        {"where": str(stat.traceback[0]), "size_diff_kb": round(stat.size_diff / 1024, 1), "count_diff": stat.count_diff}
+        for stat in stats[:limit] if stat.size_diff > 0
+    ]
+
+def mb(value: float) -> float:
+    return round(value / (1024 * 1024), 2)
+
+# ---------------------------------------------------------------------------
+# Driver
+# ---------------------------------------------------------------------------
+
+async def soak(args, main) -> dict:
+    import httpx
+
+    stats = RouteStats()
+    samples = []
+    baseline = {}
+    started = time.monotonic()
+    deadline = started + args.duration
+    measuring = asyncio.Event()
+
+    async def worker(seed: int, workload: Workload):
+        rng = random.Random(seed)
+        names = list(Workload.MIX)
+        weights = list(Workload.MIX.values())
+        while time.monotonic() < deadline:
+            request_started = time.monotonic()
+            try:
+                name, response = await workload.run(rng.choices(names, weights)[0])
+                stats.record(name, response.status_code, time.monotonic() - request_started,
+                             getattr(response, "soak_mismatch", None))
+            except Exception as e:
+                stats.record("exceptions", 599, time.monotonic() - request_started)
+                print(f"soak: request failed: {e!r}", file=sys.stderr)
+            if args.think_ms:
+                await asyncio.sleep(rng.expovariate(1000 / args.think_ms))
+
+    async def sampler():
+        await asyncio.sleep(args.warmup)
+        gc.collect()
+        if tracemalloc.is_tracing():
+            baseline["snapshot"] = tracemalloc.take_snapshot()
+        measuring.set()
+        while True:
+            sample = take_sample(main, started, stats)
+            samples.append(sample)
+            print(
+                f"[{sample['elapsed']:>8.0f}s] rss={mb(sample['rss'])}MB "
+                + (f"traced={mb(sample['traced'])}MB " if sample['traced'] is not None else "")
+                + f"fds={sample['fds']} db_fds={sample['database_fds']} "
+                f"requests={sample['requests']} errors={sample['errors']}",
+                file=sys.stderr
+            )
+            await asyncio.sleep(args.sample_interval)
+
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://soak", timeout=60) as http:
+            sampling = asyncio.create_task(sampler())
+            await asyncio.gather(*(
+                worker(args.seed + i, Workload(http, args.seed + i)) for i in range(args.concurrency)
+            ))
+            sampling.cancel()
+            if not measuring.is_set():
+                raise SystemExit("The run ended before the warmup did; raise --duration or lower --warmup")
+
+        # Let background flushes and revalidations finish, then measure what stays
+        await asyncio.sleep(args.settle)
+        gc.collect()
+        final = take_sample(main, started, stats)
+        samples.append(final)
+        # The warmer may hold a connection for a moment; a leaked one never closes
+        database_path = os.path.realpath(main.DATABASE_PATH)
+        for _ in range(10):
+            if not final["database_fds"]:
+                break
+            await asyncio.sleep(0.5)
+            final["database_fds"] = min(final["database_fds"], open_fds(database_path)[1])
+        allocators = []
+        if "snapshot" in baseline:
+            allocators = top_allocators(baseline["snapshot"], tracemalloc.take_snapshot(), args.top)
+
+    result = {
+        "rss_mb": mb(growth(samples, "rss")),
+        "rss_mb_per_hour": mb(slope_per_hour(samples, "rss")),
+        "traced_mb": mb(growth(samples, "traced")) if final["traced"] is not None else None,
+        "traced_mb_per_hour": mb(slope_per_hour(samples, "traced")) if final["traced"] is not None else None,
+        "fds": growth(samples, "fds"),
+        "database_fds_at_rest": final["database_fds"],
+    }
+
+    failures = []
+    if result["rss_mb"] > args.max_rss_growth_mb:
+        failures.append(f"RSS grew {result['rss_mb']}MB (limit {args.max_rss_growth_mb}MB)")
+    if result["traced_mb"] is not None and result["traced_mb"] > args.max_traced_growth_mb:
+        failures.append(f"Traced memory grew {result['traced_mb']}MB (limit {args.max_traced_growth_mb}MB)")
+    if result["fds"] > args.max_fd_growth:
+        failures.append(f"Open file descriptors grew by {result['fds']} (limit {args.max_fd_growth})")
+    if final["database_fds"] > args.max_database_fds:
+        failures.append(f"{final['database_fds']} database descriptors open at rest (limit {args.max_database_fds})")
+    error_rate = stats.total("errors") / max(1, final["requests"])
+    if error_rate > args.max_error_rate:
+        failures.append(f"Error rate {error_rate:.2%} (limit {args.max_error_rate:.2%})")
+    if stats.total("mismatches"):
+        failures.append(f"{stats.total('mismatches')} responses with wrong contents")
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "config": {key: value for key, value in vars(args).items() if key not in ("report", "serve_upstream")},
+        "requests": stats.summary(),
+        "growth": result,
+        "globals": {"after_warmup": samples[0]["globals"], "at_rest": final["globals"]},
+        "top_allocators": allocators,
+        "samples": samples,
+        "failures": failures,
+        "passed": not failures,
+    }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Soak the backend with a mixed workload and check for memory growth")
+    parser.add_argument("--duration", type=float, default=3 * 3600, help="Seconds of load (default: 3 hours)")
+    parser.add_argument("--warmup", type=float, default=600, help="Seconds before the baseline is taken, while caches fill")
+    parser.add_argument("--sample-interval", type=float, default=60, help="Seconds between samples")
+    parser.add_argument("--settle", type=float, default=5, help="Seconds to idle after the load before the final sample")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent simulated clients")
+    parser.add_argument("--think-ms", type=float, default=50, help="Mean pause between a client's requests")
+    parser.add_argument("--convos", type=int, default=40, help="Conversations in the fake upstream")
+    parser.add_argument("--history", type=int, default=300, help="Initial messages per conversation")
+    parser.add_argument("--delete-ratio", type=float, default=0.05, help="Share of sends that also delete a message")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.2,
+                        help="Share of broadcast sends the fake upstream answers with 429")
+    parser.add_argument("--upstream-latency", type=float, default=20, help="Fake upstream latency in ms")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-tracemalloc", action="store_true", help="Skip allocation tracking (less overhead)")
+    parser.add_argument("--trace-frames", type=int, default=1, help="Frames kept per traced allocation")
+    parser.add_argument("--top", type=int, default=20, help="Allocation sites listed in the report")
+    parser.add_argument("--max-rss-growth-mb", type=float, default=64)
+    parser.add_argument("--max-traced-growth-mb", type=float, default=32)
+    parser.add_argument("--max-fd-growth", type=int, default=16)
+    parser.add_argument("--max-database-fds", type=int, default=0, help="Database descriptors allowed once idle")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--report", default="soak_report.json", help="Where to write the JSON report")
+    parser.add_argument("--serve-upstream", type=int, metavar="PORT", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_upstream:
+        serve_upstream(args.serve_upstream, args)
+        return 0
+
+    if not args.no_tracemalloc:
+        # Started before the backend is imported so every allocation is attributed
+        tracemalloc.start(args.trace_frames)
+
+    upstream, upstream_url = start_upstream(args)
+    database = tempfile.NamedTemporaryFile(prefix="sevensky_soak_", suffix=".db", delete=False)
+    database.close()
+    try:
+        os.environ.update({
+            "ATPROTO_BASE_URL": upstream_url,
+            "ATPROTO_USERNAME": SOAK_HANDLE,
+            "ATPROTO_PASSWORD": "soak",
+            "DATABASE_PATH": database.name,
+        })
+        # The same scratch settings everywhere keep runs comparable
+        os.environ.setdefault("MARK_READ_FLUSH_DELAY", "0.2")
+        os.environ.setdefault("IMAGE_COMPACT_INTERVAL", "600")
+        sys.path.insert(0, SCRIPT_DIR)
+        import logging
+        logging.basicConfig(level=logging.WARNING)
+        import main as backend
+
+        report = asyncio.run(soak(args, backend))
+    finally:
+        upstream.terminate()
+        upstream.wait()
+        for suffix in ("", "-journal", "-wal", "-shm"):
+            try:
+                os.remove(database.name + suffix)
+            except FileNotFoundError:
+                pass
+
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+
+    growth_summary = report["growth"]
+    print(json.dumps({"passed": report["passed"], "growth": growth_summary, "failures": report["failures"]}))
+    for allocator in report["top_allocators"][:5]:
+        print(f"  +{allocator['size_diff_kb']}KB {allocator['where']}", file=sys.stderr)
+    return 0 if report["passed"] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())